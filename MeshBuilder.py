@@ -1,120 +1,385 @@
 
 from typing import Any
-from matplotlib.dates import num2date
 import numpy as np
 from gltflib import (GLTF, Accessor, AccessorType, Asset, Attributes, Buffer,
-                     BufferView, ComponentType, FileResource, GLTFModel, Mesh,
-                     Node, Primitive, PrimitiveMode, Scene)
+                     BufferTarget, BufferView, ComponentType, FileResource,
+                     GLBResource, GLTFModel, Mesh, Node, Primitive,
+                     PrimitiveMode, Scene)
+import meshopt
+import metrics
 
 def create(list: list, resource: "Any"):
     id = len(list)
     list.append(resource)
     return id
 
+def _grow(array: np.ndarray, used: int, needed: int):
+    """Returns `array` or a copy with at least `needed` more rows, growing geometrically"""
+    if used + needed <= len(array):
+        return array
+
+    grown = np.empty((max(2 * len(array), used + needed),) + array.shape[1:], dtype=array.dtype)
+    grown[:used] = array[:used]
+    return grown
+
+# Faces of a cube in emission order: axis, side (0 at the low, 1 at the high coordinate) and winding
+CUBE_FACES = (
+    (2, 0, True),
+    (2, 1, False),
+    (1, 0, True),
+    (1, 1, False),
+    (0, 0, False),
+    (0, 1, True),
+)
+# Axis, side and the two in-plane (u, v) axes of every cube face
+FACE_AXES = tuple((axis, side, *[other for other in range(3) if other != axis]) for axis, side, _ in CUBE_FACES)
+
+def _subtract(rectangles: "list[tuple[float, float, float, float]]", cut: "tuple[float, float, float, float]", tolerance: float):
+    cut_u1, cut_v1, cut_u2, cut_v2 = cut
+    result = []
+    for u1, v1, u2, v2 in rectangles:
+        if cut_u1 >= u2 - tolerance or cut_u2 <= u1 + tolerance or cut_v1 >= v2 - tolerance or cut_v2 <= v1 + tolerance:
+            result.append((u1, v1, u2, v2))
+            continue
+
+        # Parts left and right of the cut over the full height, then below and above it
+        pieces = [
+            (u1, v1, cut_u1, v2),
+            (cut_u2, v1, u2, v2),
+            (max(u1, cut_u1), v1, min(u2, cut_u2), cut_v1),
+            (max(u1, cut_u1), cut_v2, min(u2, cut_u2), v2),
+        ]
+        result.extend(piece for piece in pieces if piece[2] - piece[0] > tolerance and piece[3] - piece[1] > tolerance)
+
+    return result
+
+def grid_cell_size(rectangles: np.ndarray, tolerance: float = 1e-4):
+    """Cell size of the grid hash of [N, 4] rectangles, from the typical thickness of the rectangles"""
+    extent = rectangles[:, 2:] - rectangles[:, :2]
+    return max(float(np.median(extent.min(axis=1))) * 4, tolerance * 16) if len(rectangles) else 1.0
+
+def grid_cells(rectangles: np.ndarray, cell_size: float, tolerance: float = 1e-4):
+    """
+    Grid cells covered by [N, 4] rows of x1, y1, x2, y2 grown by the
+    tolerance, as the owning row and the x and y of every covered cell.
+    """
+    first = np.floor((rectangles[:, :2] - tolerance) / cell_size).astype(np.int64)
+    last = np.floor((rectangles[:, 2:] + tolerance) / cell_size).astype(np.int64)
+    counts = (last - first + 1).prod(axis=1)
+
+    owner = np.repeat(np.arange(len(rectangles)), counts)
+    local = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    columns = (last - first + 1)[owner, 0]
+    return owner, first[owner, 0] + local % columns, first[owner, 1] + local // columns
+
+def visible_faces(boxes: np.ndarray, tolerance: float = 1e-4):
+    """
+    Visible parts of the faces of a union of axis aligned boxes, given as
+    [N, 6] rows of x1, y1, z1, x2, y2, z2. Parts of a face lying inside or
+    against another box are cut away, of coplanar faces pointing the same
+    way only the one of the earlier box is kept. Faces are only clipped while
+    they stay a single rectangle, otherwise they are kept whole.
+
+    Candidate pairs come from sorting the grid cells covered by every box,
+    only boxes sharing a cell are compared. Returns for every box the
+    visible rectangles of each face in the (u, v) plane used by `add_cube`.
+    """
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 6)
+    low, high = boxes[:, :3].tolist(), boxes[:, 3:].tolist()
+    occluders: "list[list[list[tuple[float, float, float, float]]]]" = [[[] for _ in CUBE_FACES] for _ in range(len(boxes))]
+
+    def occlude(index: int, other: int):
+        for face, (axis, side, u_axis, v_axis) in enumerate(FACE_AXES):
+            plane = high[index][axis] if side else low[index][axis]
+            other_low, other_high = low[other][axis], high[other][axis]
+
+            if side:
+                inside = other_high > plane + tolerance and other_low < plane + tolerance
+                coplanar = abs(other_high - plane) <= tolerance and other < index
+            else:
+                inside = other_low < plane - tolerance and other_high > plane - tolerance
+                coplanar = abs(other_low - plane) <= tolerance and other < index
+            if not inside and not coplanar:
+                continue
+
+            cut = (
+                max(low[index][u_axis], low[other][u_axis]), max(low[index][v_axis], low[other][v_axis]),
+                min(high[index][u_axis], high[other][u_axis]), min(high[index][v_axis], high[other][v_axis]),
+            )
+            if cut[2] - cut[0] > tolerance and cut[3] - cut[1] > tolerance:
+                occluders[index][face].append(cut)
+
+    if len(boxes):
+        footprints = boxes[:, [0, 1, 3, 4]]
+        owner, cell_x, cell_y = grid_cells(footprints, grid_cell_size(footprints, tolerance), tolerance)
+
+        order = np.lexsort((owner, cell_y, cell_x))
+        owner, cell_x, cell_y = owner[order].tolist(), cell_x[order].tolist(), cell_y[order].tolist()
+
+        pairs = set()
+        start = 0
+        for end in range(1, len(owner) + 1):
+            if end < len(owner) and cell_x[end] == cell_x[start] and cell_y[end] == cell_y[start]:
+                continue
+
+            members = owner[start:end]
+            for position, index in enumerate(members):
+                for other in members[position + 1:]:
+                    pairs.add((index, other))
+            start = end
+
+        for index, other in pairs:
+            if all(low[index][axis] <= high[other][axis] + tolerance and low[other][axis] <= high[index][axis] + tolerance for axis in range(3)):
+                occlude(index, other)
+                occlude(other, index)
+
+    result = []
+    for index in range(len(boxes)):
+        faces = []
+        for face, (_, _, u_axis, v_axis) in enumerate(FACE_AXES):
+            whole = [(low[index][u_axis], low[index][v_axis], high[index][u_axis], high[index][v_axis])]
+            rectangles = whole
+            for cut in occluders[index][face]:
+                rectangles = _subtract(rectangles, cut, tolerance)
+
+            # A face cut into several pieces costs more triangles than the hidden part saves
+            faces.append(rectangles if len(rectangles) <= 1 else whole)
+        result.append(faces)
+
+    return result
+
+# Triangles of a quad with corners 0, 1, 2, 3, and with the winding inverted
+QUAD_INDICES = np.array([0, 1, 2, 2, 3, 0], dtype=np.uint32)
+INVERTED_QUAD_INDICES = np.array([0, 3, 2, 2, 1, 0], dtype=np.uint32)
+
+def _face_corners(axis: int, side: int):
+    """Columns of an (x1, y1, z1, x2, y2, z2) row forming the four corners of a cube face"""
+    u_axis, v_axis = [other for other in range(3) if other != axis]
+    if axis == 2:
+        corners = [(0, 0), (0, 1), (1, 1), (1, 0)]
+    else:
+        corners = [(0, 0), (1, 0), (1, 1), (0, 1)]
+
+    columns = []
+    for u, v in corners:
+        corner = [0, 0, 0]
+        corner[axis] = axis + 3 * side
+        corner[u_axis] = u_axis + 3 * u
+        corner[v_axis] = v_axis + 3 * v
+        columns.append(corner)
+    return columns
+
+# [6, 4, 3] columns of the cube faces and their winding, in the order of CUBE_FACES
+CUBE_CORNERS = np.array([_face_corners(axis, side) for axis, side, _ in CUBE_FACES])
+CUBE_INVERTED = np.array([invert_normals for _, _, invert_normals in CUBE_FACES])
+
+def cube_quads(boxes: np.ndarray, faces: "list[list[list[tuple[float, float, float, float]]]] | None" = None):
+    """
+    Quads of [N, 6] boxes given as x1, y1, z1, x2, y2, z2. Without `faces`
+    every box gets its six faces, otherwise `faces` holds the rectangles of
+    each face of every box in its (u, v) plane, see `visible_faces`.
+    Returns the [M, 4, 3] quads, their winding and the quad count of every box.
+    """
+
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 6)
+    if faces is None:
+        quads = boxes[:, CUBE_CORNERS].reshape(-1, 4, 3)
+        return quads, np.tile(CUBE_INVERTED, len(boxes)), np.full(len(boxes), len(CUBE_FACES))
+
+    # Every rectangle becomes a flat box on its face plane
+    rows = []
+    face_ids = []
+    counts = []
+    for box, box_faces in zip(boxes.tolist(), faces):
+        count = 0
+        for face, (axis, side, u_axis, v_axis) in enumerate(FACE_AXES):
+            for u1, v1, u2, v2 in box_faces[face]:
+                row = list(box)
+                row[axis + 3 * (1 - side)] = row[axis + 3 * side]
+                row[u_axis], row[u_axis + 3] = u1, u2
+                row[v_axis], row[v_axis + 3] = v1, v2
+                rows.append(row)
+                face_ids.append(face)
+                count += 1
+        counts.append(count)
+
+    rows = np.array(rows, dtype=np.float32).reshape(-1, 6)
+    face_ids = np.array(face_ids, dtype=np.int64)
+    quads = rows[np.arange(len(rows))[:, None, None], CUBE_CORNERS[face_ids]]
+    return quads, CUBE_INVERTED[face_ids], np.array(counts, dtype=np.int64)
+
+INSTANCING_EXTENSION = "EXT_mesh_gpu_instancing"
+QUANTIZATION_EXTENSION = "KHR_mesh_quantization"
+LOD_EXTENSION = "MSFT_lod"
+
+# Screen coverage below which the low detail level is shown and below which nothing is
+LOD_SCREEN_COVERAGE = (0.25, 0.0)
+
+# Buffer views of the packed mode, views left empty are dropped in `build`
+POSITION_VIEW = 0
+INDEX_VIEW = 1
+WIDE_INDEX_VIEW = 2
+QUANTIZED_VIEW = 3
+
+# Most nodes under one parent of the bounding volume hierarchy
+BVH_LEAF_SIZE = 8
+
 class MeshBuilder:
-    def __init__(self) -> None:
+    """
+    Builds a glTF with one node and mesh per `create_mesh` call. In packed
+    mode all meshes share a single buffer holding one view of positions and
+    one per index width, written as the only BIN chunk of a GLB. Otherwise
+    every mesh gets its own buffer.
+
+    Packed builders can also quantize the mesh positions to uint16 on a grid
+    shared by all meshes (KHR_mesh_quantization), the node of every mesh
+    scales and translates them back, and compress every view with the
+    EXT_meshopt_compression codecs.
+
+    With `hierarchy` the nodes are grouped under a bounding volume hierarchy
+    of parent nodes instead of all being roots of the scene. Nodes added after
+    `begin_lod` form a lower level of detail, each level gets a parent node
+    and the full detail one links the others through MSFT_lod.
+    """
+
+    def __init__(self, capacity: int = 1024, packed: bool = True, quantize: bool = False, compress: bool = False, hierarchy: bool = False) -> None:
+        if (quantize or compress) and not packed:
+            raise ValueError("Quantization and compression need a packed MeshBuilder")
+
         self.gltf_nodes: "list[Node]" = []
         self.gltf_buffers: "list[Buffer]" = []
         self.gltf_resources: "list[Any]" = []
         self.gltf_buffer_views: "list[BufferView]" = []
         self.gltf_accessors: "list[Accessor]" = []
         self.gltf_meshes: "list[Mesh]" = []
-        self.vertex_stack: "list[list[float]]" = []
-        self.index_stack: "list[int]" = []
-        pass
-    
-    def add_quad(self, a, b, c, d, invert_normals = False):
-        i = len(self.vertex_stack)
-        if invert_normals:
-            self.index_stack.extend([i + 0, i + 3, i + 2, i + 2, i + 1, i + 0])
-        else:
-            self.index_stack.extend([i + 0, i + 1, i + 2, i + 2, i + 3, i + 0])
-        self.vertex_stack.extend([a, b, c, d])
-
-    def add_cube(self, x1: float, y1: float, x2: float, y2: float, z1: float, z2: float):
-         # Z-
-        self.add_quad(
-            [x1, y1, z1],
-            [x1, y2, z1],
-            [x2, y2, z1],
-            [x2, y1, z1],
-            invert_normals=True,
-        )
 
-        # Z+
-        self.add_quad(
-            [x1, y1, z2],
-            [x1, y2, z2],
-            [x2, y2, z2],
-            [x2, y1, z2],
-        )
+        # Geometry of the mesh being built, vertices are stored as (x, z, y) like in the glTF
+        self.vertices = np.empty((capacity, 3), dtype=np.float32)
+        self.indices = np.empty(capacity * 3 // 2, dtype=np.uint32)
+        self.vertex_count = 0
+        self.index_count = 0
+
+        # Geometry of all meshes in packed mode
+        self.packed = packed
+        self.packed_vertices = np.empty((capacity, 3), dtype=np.float32)
+        self.packed_indices = np.empty(capacity * 3 // 2, dtype=np.uint16)
+        self.packed_wide_indices = np.empty(0, dtype=np.uint32)
+        self.packed_vertex_count = 0
+        self.packed_index_count = 0
+        self.packed_wide_index_count = 0
+        self.extensions: "set[str]" = set()
+        # Extensions loaders may ignore, they fall back to the full detail
+        self.optional_extensions: "set[str]" = set()
+        self.hierarchy = hierarchy
+        # First node of every lower level of detail
+        self.lod_starts: "list[int]" = []
+        # Bounds of every node as created, in the glTF axes
+        self.node_bounds: "list[tuple[np.ndarray, np.ndarray]]" = []
+
+        # Float positions of the meshes to quantize and their (accessor, node, start, count)
+        self.quantize = quantize
+        self.compress = compress
+        self.quantized_vertices = np.empty((0, 3), dtype=np.float32)
+        self.quantized_vertex_count = 0
+        self.quantized_meshes: "list[tuple[int, int, int, int]]" = []
+
+    def _reserve(self, vertices: int, indices: int):
+        self.vertices = _grow(self.vertices, self.vertex_count, vertices)
+        self.indices = _grow(self.indices, self.index_count, indices)
+
+    def add_quads(self, quads: np.ndarray, invert_normals: "bool | np.ndarray" = False):
+        """Adds [N, 4, 3] quads, `invert_normals` is either shared or given per quad"""
+        quads = np.asarray(quads, dtype=np.float32).reshape(-1, 4, 3)
+        count = len(quads)
+        self._reserve(4 * count, 6 * count)
+
+        start = self.vertex_count
+        points = quads.reshape(-1, 3)
+        block = self.vertices[start:start + 4 * count]
+        block[:, 0] = points[:, 0]
+        block[:, 1] = points[:, 2]
+        block[:, 2] = points[:, 1]
+
+        template = np.where(np.asarray(invert_normals)[..., None], INVERTED_QUAD_INDICES, QUAD_INDICES)
+        offsets = start + 4 * np.arange(count, dtype=np.uint32)
+        self.indices[self.index_count:self.index_count + 6 * count] = (np.broadcast_to(template, (count, 6)) + offsets[:, None]).ravel()
+
+        self.vertex_count += 4 * count
+        self.index_count += 6 * count
 
-        # Y+
-        self.add_quad(
-            [x1, y1, z1],
-            [x2, y1, z1],
-            [x2, y1, z2],
-            [x1, y1, z2],
-            invert_normals=True,
-        )
-
-        # Y-
-        self.add_quad(
-            [x1, y2, z1],
-            [x2, y2, z1],
-            [x2, y2, z2],
-            [x1, y2, z2],
-        )
+    def add_quad(self, a, b, c, d, invert_normals = False):
+        self.add_quads(np.array([a, b, c, d]), invert_normals)
 
-        # X+
-        self.add_quad(
-            [x1, y1, z1],
-            [x1, y2, z1],
-            [x1, y2, z2],
-            [x1, y1, z2],
-        )
+    def add_cubes(self, boxes: np.ndarray, faces: "list[list[list[tuple[float, float, float, float]]]] | None" = None):
+        """Adds [N, 6] boxes given as x1, y1, z1, x2, y2, z2, `faces` as in `cube_quads`"""
+        quads, inverted, _ = cube_quads(boxes, faces)
+        self.add_quads(quads, inverted)
 
-        # X-
-        self.add_quad(
-            [x2, y1, z1],
-            [x2, y2, z1],
-            [x2, y2, z2],
-            [x2, y1, z2],
-            invert_normals=True,
-        )
+    def add_cube(self, x1: float, y1: float, x2: float, y2: float, z1: float, z2: float, faces: "list[list[tuple[float, float, float, float]]] | None" = None):
+        self.add_cubes(np.array([x1, y1, z1, x2, y2, z2]), None if faces is None else [faces])
 
     def create_mesh(self, name: str, indices = None, vertices = None, invert_normals = False):
         if indices is None:
-            indices = self.index_stack
-            self.index_stack = []
-            
-        if vertices is None:
-            vertices = self.vertex_stack
-            self.vertex_stack = []
-
-        # 1. Define the Mesh Data (Vertices and Indices)
-
-        # Example: A simple square (two triangles)
-        # Vertices (x, y, z) - float32 is common for positions
-        # Note: glTF uses a right-handed coordinate system, typically Y-up.
-        vertices = np.array(
-            vertices,
-            dtype=np.float32,
-        )
-
-        # Indices (to form two triangles: 0-1-2 and 1-3-2) - uint16 is common for indices
+            indices = self.indices[:self.index_count]
+            self.index_count = 0
+        else:
+            indices = np.asarray(indices)
 
-        indices = np.array(
-            indices,
-            dtype=np.uint16,
-        )
+        if vertices is None:
+            vertices = self.vertices[:self.vertex_count]
+            self.vertex_count = 0
+        else:
+            vertices = np.asarray(vertices, dtype=np.float32)[:, [0, 2, 1]]
 
         if invert_normals:
             indices = indices[::-1]
 
-        # 2. Reorder the columns to (0, 2, 1) using fancy indexing
-        # This selects column 0 (X), the modified column 2 (-Z), and column 1 (Y)
-        vertices = vertices[:, [0, 2, 1]]
+        self._add_mesh(name, vertices, indices)
+
+    def create_meshes(self, names: "list[str]", quad_counts: "list[int]"):
+        """Splits the pending quads into consecutive meshes with the given number of quads each"""
+        vertex_start = 0
+        for name, count in zip(names, quad_counts):
+            vertex_end = vertex_start + 4 * count
+            indices = self.indices[vertex_start // 4 * 6:vertex_end // 4 * 6] - vertex_start
+            self._add_mesh(name, self.vertices[vertex_start:vertex_end], indices)
+            vertex_start = vertex_end
+
+        self.vertex_count = 0
+        self.index_count = 0
+
+    def create_grouped_mesh(self, name: str, names: "list[str]", quad_counts: "list[int]"):
+        """
+        Makes one mesh of all pending quads. The index range of every group of
+        `quad_counts` quads is listed with its name in the node extras.
+        """
+
+        starts = np.cumsum([0] + list(quad_counts[:-1])) * 6
+        elements = [
+            {"name": element, "first": int(start), "count": count * 6}
+            for element, start, count in zip(names, starts.tolist(), quad_counts)
+        ]
+        indices = self.indices[:self.index_count]
+        vertices = self.vertices[:self.vertex_count]
+        self.vertex_count = self.index_count = 0
+
+        if len(indices):
+            self._add_mesh(name, vertices, indices, extras={"elements": elements})
+
+    def _add_mesh(self, name: str, vertices: np.ndarray, indices: np.ndarray, node: bool = True, instances: int = 1, extras: "dict | None" = None):
+        # The largest value of an index type is reserved, uint16 fits up to 65535 vertices
+        if len(vertices) <= 0xFFFF:
+            indices = indices.astype(np.uint16)
+            index_type = ComponentType.UNSIGNED_SHORT
+        else:
+            indices = indices.astype(np.uint32)
+            index_type = ComponentType.UNSIGNED_INT
+
+        metrics.count(metrics.TRIANGLES, len(indices) // 3 * instances, name="triangles")
+
+        if self.packed:
+            return self._add_packed_mesh(name, vertices, indices, index_type, node, extras)
 
         # 2. Convert Data to Binary Buffers
 
@@ -171,7 +436,7 @@ class MeshBuilder:
         index_accessor = create(self.gltf_accessors, Accessor(
             bufferView=index_buffer_id,
             byteOffset=0,
-            componentType=ComponentType.UNSIGNED_SHORT, # Corresponds to np.uint16
+            componentType=index_type.value,
             count=len(indices),
             type=AccessorType.SCALAR.value, # Single value per index
         ))
@@ -186,17 +451,301 @@ class MeshBuilder:
         )
 
         mesh = create(self.gltf_meshes, Mesh(primitives=[primitive], name="SquareMesh"))
-        create(self.gltf_nodes, Node(mesh=mesh, name=name))
+        if node:
+            self._add_node(Node(mesh=mesh, name=name, extras=extras), vertices.min(axis=0), vertices.max(axis=0))
+        return mesh
+
+    def _add_packed_mesh(self, name: str, vertices: np.ndarray, indices: np.ndarray, index_type: ComponentType, node: bool, extras: "dict | None"):
+        # Accessors can not be empty, meshes without triangles are left out
+        if len(indices) == 0:
+            return None
+
+        # The views are created in `build`, accessors refer to them by the *_VIEW constants until then
+        if index_type == ComponentType.UNSIGNED_SHORT:
+            index_view = INDEX_VIEW
+            index_start = self.packed_index_count
+            self.packed_indices = _grow(self.packed_indices, index_start, len(indices))
+            self.packed_indices[index_start:index_start + len(indices)] = indices
+            self.packed_index_count += len(indices)
+        else:
+            index_view = WIDE_INDEX_VIEW
+            index_start = self.packed_wide_index_count
+            self.packed_wide_indices = _grow(self.packed_wide_indices, index_start, len(indices))
+            self.packed_wide_indices[index_start:index_start + len(indices)] = indices
+            self.packed_wide_index_count += len(indices)
+
+        if self.quantize and node:
+            # Stored as uint16 VEC3 padded to 8 bytes, the bounds are known in `build`
+            vertex_start = self.quantized_vertex_count
+            self.quantized_vertices = _grow(self.quantized_vertices, vertex_start, len(vertices))
+            self.quantized_vertices[vertex_start:vertex_start + len(vertices)] = vertices
+            self.quantized_vertex_count += len(vertices)
+            position_accessor = create(self.gltf_accessors, Accessor(
+                bufferView=QUANTIZED_VIEW,
+                byteOffset=vertex_start * 8,
+                componentType=ComponentType.UNSIGNED_SHORT.value,
+                count=len(vertices),
+                type=AccessorType.VEC3.value,
+            ))
+        else:
+            vertex_start = self.packed_vertex_count
+            self.packed_vertices = _grow(self.packed_vertices, vertex_start, len(vertices))
+            self.packed_vertices[vertex_start:vertex_start + len(vertices)] = vertices
+            self.packed_vertex_count += len(vertices)
+            position_accessor = create(self.gltf_accessors, Accessor(
+                bufferView=POSITION_VIEW,
+                byteOffset=vertex_start * 12,
+                componentType=ComponentType.FLOAT.value,
+                count=len(vertices),
+                type=AccessorType.VEC3.value,
+                max=vertices.max(axis=0).tolist(),
+                min=vertices.min(axis=0).tolist(),
+            ))
+        index_accessor = create(self.gltf_accessors, Accessor(
+            bufferView=index_view,
+            byteOffset=index_start * indices.itemsize,
+            componentType=index_type.value,
+            count=len(indices),
+            type=AccessorType.SCALAR.value,
+        ))
+
+        primitive = Primitive(
+            attributes=Attributes(POSITION=position_accessor),
+            indices=index_accessor,
+            mode=PrimitiveMode.TRIANGLES.value,
+        )
+        mesh = create(self.gltf_meshes, Mesh(primitives=[primitive], name="SquareMesh"))
+        if node:
+            node_id = self._add_node(Node(mesh=mesh, name=name, extras=extras), vertices.min(axis=0), vertices.max(axis=0))
+            if self.quantize:
+                self.quantized_meshes.append((position_accessor, node_id, vertex_start, len(vertices)))
+        return mesh
+
+    def _add_packed_vec3(self, values: np.ndarray):
+        """Appends float VEC3 values to the packed vertex stream, returns their accessor"""
+        start = self.packed_vertex_count
+        self.packed_vertices = _grow(self.packed_vertices, start, len(values))
+        self.packed_vertices[start:start + len(values)] = values
+        self.packed_vertex_count += len(values)
+
+        return create(self.gltf_accessors, Accessor(
+            bufferView=POSITION_VIEW,
+            byteOffset=start * 12,
+            componentType=ComponentType.FLOAT.value,
+            count=len(values),
+            type=AccessorType.VEC3.value,
+        ))
+
+    def add_instances(self, name: str, boxes: np.ndarray, names: "list[str] | None" = None, extras: "dict | None" = None, extension: bool = True):
+        """
+        Adds [N, 6] boxes (x1, y1, z1, x2, y2, z2) as translated and scaled
+        instances of one unit cube mesh. With `extension` a single node holds
+        all instances through EXT_mesh_gpu_instancing, which needs the packed
+        mode, otherwise every box becomes a node named from `names`.
+        """
+
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 6)
+        if len(boxes) == 0:
+            return
+
+        self.add_cubes(np.array([0, 0, 0, 1, 1, 1]))
+        indices = self.indices[:self.index_count]
+        vertices = self.vertices[:self.vertex_count]
+        self.vertex_count = self.index_count = 0
+
+        # Instance transforms in the (x, z, y) axes of the glTF
+        translations = boxes[:, [0, 2, 1]]
+        scales = (boxes[:, 3:] - boxes[:, :3])[:, [0, 2, 1]]
+        lows = np.minimum(translations, translations + scales)
+        highs = np.maximum(translations, translations + scales)
+
+        if extension:
+            if not self.packed:
+                raise ValueError("EXT_mesh_gpu_instancing needs a packed MeshBuilder")
+
+            mesh = self._add_mesh(name, vertices, indices, node=False, instances=len(boxes))
+            attributes = {"TRANSLATION": self._add_packed_vec3(translations), "SCALE": self._add_packed_vec3(scales)}
+            node = Node(mesh=mesh, name=name, extras=extras, extensions={INSTANCING_EXTENSION: {"attributes": attributes}})
+            self._add_node(node, lows.min(axis=0), highs.max(axis=0))
+            self.extensions.add(INSTANCING_EXTENSION)
+            return
+
+        mesh = self._add_mesh(name, vertices, indices, node=False, instances=len(boxes))
+        for index, (translation, scale) in enumerate(zip(translations.tolist(), scales.tolist())):
+            self._add_node(Node(mesh=mesh, name=names[index] if names else name, translation=translation, scale=scale), lows[index], highs[index])
+
+    def begin_lod(self):
+        """Nodes added from here on form the next lower level of detail"""
+        self.lod_starts.append(len(self.gltf_nodes))
+
+    def _add_node(self, node: Node, low: np.ndarray, high: np.ndarray):
+        """Adds a root node with its bounds in the glTF axes"""
+        self.node_bounds.append((low, high))
+        return create(self.gltf_nodes, node)
+
+    def _build_hierarchy(self, members: np.ndarray):
+        """
+        Puts the nodes under a bounding volume hierarchy of parent nodes, each
+        listing the bounds of its subtree in `extras`. Nodes are split at the
+        median center along the longest axis of their centers until at most
+        BVH_LEAF_SIZE are left, which takes O(n log n). Returns the root.
+        """
+
+        lows = np.array([low for low, _ in self.node_bounds], dtype=np.float64).reshape(-1, 3)
+        highs = np.array([high for _, high in self.node_bounds], dtype=np.float64).reshape(-1, 3)
+        centers = (lows + highs) / 2
+
+        def split(members: np.ndarray):
+            if len(members) <= BVH_LEAF_SIZE:
+                children = members.tolist()
+            else:
+                spread = centers[members].max(axis=0) - centers[members].min(axis=0)
+                half = len(members) // 2
+                order = np.argpartition(centers[members, np.argmax(spread)], half)
+                children = [split(members[order[:half]]), split(members[order[half:]])]
+
+            low = lows[members].min(axis=0)
+            high = highs[members].max(axis=0)
+            node = Node(name="Bounds", children=children, extras={"min": low.tolist(), "max": high.tolist()})
+            return create(self.gltf_nodes, node)
+
+        return split(members)
+
+    def _quantize(self):
+        """
+        Rounds the positions of the quantized meshes to a grid shared by all
+        of them, so vertices on the seams between meshes stay together. The
+        grid step fits the largest mesh into 16 bits, the node of every mesh
+        is translated to a grid point near its minimum and scaled by the step.
+        """
+
+        count = self.quantized_vertex_count
+        if count == 0:
+            return np.empty((0, 8), dtype=np.uint8)
+
+        vertices = self.quantized_vertices[:count].astype(np.float64)
+        starts = np.array([start for _, _, start, _ in self.quantized_meshes])
+        counts = np.array([size for _, _, _, size in self.quantized_meshes])
+        minimum = np.minimum.reduceat(vertices, starts, axis=0)
+        maximum = np.maximum.reduceat(vertices, starts, axis=0)
+
+        # One step of slack for the offsets rounded down to the grid
+        step = float((maximum - minimum).max()) / 0xFFFE or 1.0
+        offsets = np.floor(minimum / step) * step
+        quantized = np.zeros((count, 4), dtype=np.uint16)
+        quantized[:, :3] = np.clip(np.rint((vertices - np.repeat(offsets, counts, axis=0)) / step), 0, 0xFFFF)
+
+        lows = np.minimum.reduceat(quantized[:, :3], starts, axis=0).tolist()
+        highs = np.maximum.reduceat(quantized[:, :3], starts, axis=0).tolist()
+        for (accessor, node, _, _), offset, low, high in zip(self.quantized_meshes, offsets.tolist(), lows, highs):
+            self.gltf_accessors[accessor].min = low
+            self.gltf_accessors[accessor].max = high
+            self.gltf_nodes[node].translation = offset
+            self.gltf_nodes[node].scale = [step] * 3
+            self.node_bounds[node] = (np.add(offset, np.multiply(low, step)), np.add(offset, np.multiply(high, step)))
+
+        self.extensions.add(QUANTIZATION_EXTENSION)
+        return quantized.view(np.uint8)
+
+    def _build_packed_buffer(self):
+        """Copies the views once into the GLB binary chunk, each padded to 4 bytes"""
+        # View, [count, stride] bytes, whether it holds indices
+        views = [
+            (POSITION_VIEW, self.packed_vertices[:self.packed_vertex_count].view(np.uint8), False),
+            (INDEX_VIEW, self.packed_indices[:self.packed_index_count, None].view(np.uint8), True),
+            (WIDE_INDEX_VIEW, self.packed_wide_indices[:self.packed_wide_index_count, None].view(np.uint8), True),
+            (QUANTIZED_VIEW, self._quantize(), False),
+        ]
+        views = [view for view in views if len(view[1])]
+        if not views:
+            return
+
+        # Accessors refer to the views by their *_VIEW constant until here
+        view_ids = {view: index for index, (view, _, _) in enumerate(views)}
+        for accessor in self.gltf_accessors:
+            accessor.bufferView = view_ids[accessor.bufferView]
+
+        chunks = []
+        offset = 0
+        for _, data, indices in views:
+            stride = data.shape[1]
+            view = BufferView(
+                buffer=0,
+                byteOffset=offset,
+                byteLength=data.size,
+                byteStride=None if indices else stride,
+                target=(BufferTarget.ELEMENT_ARRAY_BUFFER if indices else BufferTarget.ARRAY_BUFFER).value,
+            )
+            self.gltf_buffer_views.append(view)
+            chunks.append((view, data))
+            offset += (data.size + 3) // 4 * 4
+
+        if self.compress:
+            # The views keep their layout in a fallback buffer without data, their bytes come from the extension
+            compressed = bytearray()
+            for view, data in chunks:
+                stride = data.shape[1]
+                if view.target == BufferTarget.ELEMENT_ARRAY_BUFFER.value:
+                    encoded, mode = meshopt.encode_index_sequence(data.view(np.uint16 if stride == 2 else np.uint32).ravel()), "INDICES"
+                else:
+                    encoded, mode = meshopt.encode_vertex_buffer(data), "ATTRIBUTES"
+
+                view.buffer = 1
+                view.extensions = {meshopt.EXTENSION: {
+                    "buffer": 0,
+                    "byteOffset": len(compressed),
+                    "byteLength": len(encoded),
+                    "byteStride": stride,
+                    "count": len(data),
+                    "mode": mode,
+                }}
+                compressed += encoded + bytes(-len(encoded) % 4)
+
+            self.gltf_buffers = [
+                Buffer(byteLength=len(compressed)),
+                Buffer(byteLength=offset, extensions={meshopt.EXTENSION: {"fallback": True}}),
+            ]
+            self.gltf_resources = [GLBResource(bytes(compressed))]
+            self.extensions.add(meshopt.EXTENSION)
+            return
+
+        data = np.zeros(offset, dtype=np.uint8)
+        for view, chunk in chunks:
+            data[view.byteOffset:view.byteOffset + chunk.size] = chunk.ravel()
+
+        self.gltf_buffers = [Buffer(byteLength=len(data))]
+        self.gltf_resources = [GLBResource(data)]
 
     def build(self):
+        if self.packed:
+            self._build_packed_buffer()
+
+        edges = [0] + self.lod_starts + [len(self.gltf_nodes)]
+        levels = []
+        for start, end in zip(edges[:-1], edges[1:]):
+            if self.hierarchy and end > start:
+                levels.append([self._build_hierarchy(np.arange(start, end))])
+            else:
+                levels.append(list(range(start, end)))
+
+        roots = levels[0]
+        if self.lod_starts:
+            lods = [create(self.gltf_nodes, Node(name=f"LOD{level}", children=children)) for level, children in enumerate(levels)]
+            self.gltf_nodes[lods[0]].extensions = {LOD_EXTENSION: {"ids": lods[1:]}}
+            self.gltf_nodes[lods[0]].extras = {"MSFT_screencoverage": list(LOD_SCREEN_COVERAGE)}
+            self.optional_extensions.add(LOD_EXTENSION)
+            roots = lods[:1]
+
         model = GLTFModel(
             asset=Asset(version='2.0'),
-            scenes=[Scene(nodes=list(range(len(self.gltf_nodes))))],
+            scenes=[Scene(nodes=roots)],
             nodes=self.gltf_nodes,
             meshes=self.gltf_meshes,
             buffers=self.gltf_buffers,
             bufferViews=self.gltf_buffer_views,
-            accessors=self.gltf_accessors
+            accessors=self.gltf_accessors,
+            extensionsUsed=sorted(self.extensions | self.optional_extensions) or None,
+            extensionsRequired=sorted(self.extensions) or None,
         )
 
         return GLTF(model=model, resources=self.gltf_resources)
\ No newline at end of file
@@ -6,7 +6,9 @@ import numpy
 
 
 
-from build_3d_model import build_3d_model
+from build_3d_model import Detections, GeometryOptions, build_3d_model
+from glb import GLBStream
+from session import GeometrySession, SessionStore
 from mrcnn.config import Config
 
 from mrcnn.model import MaskRCNN
@@ -16,24 +18,67 @@ from skimage.color import gray2rgb
 
 
 
-from io import BytesIO
-from numpy import expand_dims
-from flask import Flask, request,send_file
+from flask import Flask, request,jsonify,Response
 
 from mrcnn.model import mold_image
 
 import tensorflow as tf
 import sys
+import queue
+import threading
+import time
+import logging
+import json
+from dataclasses import asdict, replace
 
+import autotune
+import metrics
+import profiling
+import memory
+import hashlib
+import keras.backend as K
 
 
 
 
-global _model
-global _graph
+
+global _pool
+global _tuning
 global cfg
+_pool = None
+_tuning = None
 ROOT_DIR = os.path.abspath("./")
 WEIGHTS_FOLDER = "./weights"
+AUTOTUNE_FOLDER = "./autotune"
+PROFILE_FOLDER = "./profiles"
+
+# Set FLOORPLAN_AUTOTUNE=1 to measure the session layout for this host before serving
+AUTOTUNE = os.environ.get("FLOORPLAN_AUTOTUNE", "0") == "1"
+AUTOTUNE_LATENCY_TARGET = float(os.environ.get("FLOORPLAN_LATENCY_TARGET", "5.0"))
+
+# Set FLOORPLAN_PROFILE_EVERY=N to profile one in N requests into PROFILE_FOLDER
+PROFILE_EVERY = int(os.environ.get("FLOORPLAN_PROFILE_EVERY", "0"))
+PROFILE_KEEP = int(os.environ.get("FLOORPLAN_PROFILE_KEEP", "50"))
+
+# Set FLOORPLAN_MEMORY_TRACKING=1 to record allocations per stage with tracemalloc
+MEMORY_TRACKING = os.environ.get("FLOORPLAN_MEMORY_TRACKING", "0") == "1"
+# Concurrent requests are admitted while their estimated memory fits the budget, 0 disables the limit
+MEMORY_BUDGET = int(float(os.environ.get("FLOORPLAN_MEMORY_BUDGET_MB", "0")) * 1024 * 1024)
+MEMORY_BYTES_PER_PIXEL = float(os.environ.get("FLOORPLAN_BYTES_PER_PIXEL", "64"))
+
+# Set FLOORPLAN_INSTANCING=ext (EXT_mesh_gpu_instancing) or nodes to share one box mesh per element kind
+# Set FLOORPLAN_CONSOLIDATE=1 to bake one mesh per category instead of one per element
+# Set FLOORPLAN_QUANTIZE=1 and FLOORPLAN_COMPRESS=1 for uint16 positions and meshopt compressed buffers
+# Set FLOORPLAN_HIERARCHY=1 to group the nodes under a bounding volume hierarchy
+# Set FLOORPLAN_LOD=msft to add a low detail level, requests can also ask for ?lod=low or ?lod=msft
+GEOMETRY_OPTIONS = GeometryOptions.from_environment(os.environ)
+
+# Editing sessions kept in memory, requests with ?session=1 open one, the least recently used are dropped
+SESSION_CAPACITY = int(os.environ.get("FLOORPLAN_SESSIONS", "32"))
+
+# Per request details are logged at DEBUG, set FLOORPLAN_LOG_LEVEL=DEBUG to see them
+logging.basicConfig(level=os.environ.get("FLOORPLAN_LOG_LEVEL", "INFO"))
+logger = logging.getLogger("application")
 
 from flask_cors import CORS
 
@@ -42,8 +87,15 @@ sys.path.append(ROOT_DIR)
 MODEL_NAME = "mask_rcnn_hq"
 WEIGHTS_FILE_NAME = 'maskrcnn_15_epochs.h5'
 
+_profiler = profiling.SamplingProfiler(PROFILE_EVERY, PROFILE_FOLDER, keep=PROFILE_KEEP)
+_memory = memory.MemoryTracker()
+if MEMORY_TRACKING:
+	_memory.start()
+_budget = memory.MemoryBudget(MEMORY_BUDGET, MEMORY_BYTES_PER_PIXEL)
+_sessions = SessionStore(SESSION_CAPACITY)
+
 application=Flask(__name__)
-cors = CORS(application, resources={r"/*": {"origins": "*"}})
+cors = CORS(application, resources={r"/*": {"origins": "*"}}, expose_headers=["Server-Timing", "X-Stage-Breakdown", "X-Session-Id", "X-Changed-Nodes", "X-Removed-Nodes"])
 
 
 class PredictionConfig(Config):
@@ -56,20 +108,179 @@ class PredictionConfig(Config):
 	IMAGES_PER_GPU = 1
 	DETECTION_MIN_CONFIDENCE = 0.5
 	
+def createConfig(batchSize):
+	class TunedPredictionConfig(PredictionConfig):
+		IMAGES_PER_GPU = batchSize
+
+	return TunedPredictionConfig()
+
+class ModelWorker:
+	"""One model instance with its own graph and session"""
+
+	def __init__(self, config, settings):
+		model_folder_path = os.path.abspath("./") + "/mrcnn"
+		weights_path= os.path.join(WEIGHTS_FOLDER, WEIGHTS_FILE_NAME)
+		session_config = tf.ConfigProto(
+			intra_op_parallelism_threads=settings.intra_op_threads,
+			inter_op_parallelism_threads=settings.inter_op_threads,
+		)
+		self.batchSize = config.BATCH_SIZE
+		self.graph = tf.Graph()
+		self.session = tf.Session(graph=self.graph, config=session_config)
+		with self.graph.as_default(), self.session.as_default():
+			self.model = MaskRCNN(mode='inference', model_dir=model_folder_path,config=config)
+			self.model.load_weights(weights_path, by_name=True)
+
+	def detect(self, images):
+		"""Same as MaskRCNN.detect, split into timed stages"""
+		model = self.model
+		with metrics.stage("mold"):
+			molded_images, image_metas, windows = model.mold_inputs(images)
+			anchors = model.get_anchors(molded_images[0].shape)
+			anchors = numpy.broadcast_to(anchors, (self.batchSize,) + anchors.shape)
+
+		profiles = profiling.current()
+		with metrics.stage("predict"):
+			with self.graph.as_default(), self.session.as_default():
+				if profiles:
+					detections, _, _, mrcnn_mask, _, _, _ = self.predictTraced([molded_images, image_metas, anchors], profiles)
+				else:
+					detections, _, _, mrcnn_mask, _, _, _ = model.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+
+		results = []
+		with metrics.stage("unmold"):
+			for i, image in enumerate(images):
+				rois, class_ids, scores, masks = model.unmold_detections(
+					detections[i], mrcnn_mask[i], image.shape, molded_images[i].shape, windows[i])
+				results.append({
+					"rois": rois,
+					"class_ids": class_ids,
+					"scores": scores,
+					"masks": masks,
+				})
+		return results
+
+	def predictTraced(self, inputs, profiles):
+		"""Runs the keras model directly in the session to collect the step trace"""
+		from tensorflow.python.client import timeline
+
+		keras_model = self.model.keras_model
+		feed = dict(zip(keras_model.inputs, inputs))
+		if keras_model.uses_learning_phase:
+			feed[K.learning_phase()] = 0
+
+		run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+		run_metadata = tf.RunMetadata()
+		outputs = self.session.run(keras_model.outputs, feed_dict=feed, options=run_options, run_metadata=run_metadata)
+
+		step_trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+		for profile in profiles:
+			profile.add_step_trace(step_trace)
+		return outputs
+
+	def close(self):
+		self.session.close()
+
+class PendingDetection:
+	def __init__(self, image):
+		self.image = image
+		self.trace = metrics.current_trace()
+		self.profiles = profiling.current()
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+class ModelPool:
+	"""
+	Hands out model workers to requests. With a batch size above one, the
+	request that obtains a worker runs the batch for everyone waiting.
+	"""
+
+	def __init__(self, workers, batchWait=0.02):
+		self.batchSize = workers[0].batchSize
+		self.batchWait = batchWait
+		self.idle = queue.Queue()
+		self.pending = queue.Queue()
+		for worker in workers:
+			self.idle.put(worker)
+
+	def detect(self, image):
+		if self.batchSize == 1:
+			worker = self.idle.get()
+			try:
+				return worker.detect([image])[0]
+			finally:
+				self.idle.put(worker)
+
+		job = PendingDetection(image)
+		self.pending.put(job)
+		while not job.done.is_set():
+			try:
+				worker = self.idle.get(timeout=self.batchWait)
+			except queue.Empty:
+				continue
+
+			try:
+				self.runBatch(worker)
+			finally:
+				self.idle.put(worker)
+
+		if job.error is not None:
+			raise job.error
+		return job.result
+
+	def runBatch(self, worker):
+		jobs = []
+		deadline = time.perf_counter() + self.batchWait
+		while len(jobs) < self.batchSize:
+			try:
+				jobs.append(self.pending.get(timeout=max(0, deadline - time.perf_counter())))
+			except queue.Empty:
+				break
+
+		if not jobs:
+			return
+
+		# The model is built for a fixed batch size, pad partial batches
+		images = [job.image for job in jobs]
+		images += [images[-1]] * (self.batchSize - len(images))
+
+		try:
+			with metrics.activate([job.trace for job in jobs]), profiling.activate([profile for job in jobs for profile in job.profiles]):
+				results = worker.detect(images)
+		except Exception as error:
+			for job in jobs:
+				job.error = error
+				job.done.set()
+			return
+
+		for job, result in zip(jobs, results):
+			job.result = result
+			job.done.set()
+
+def createWorkers(settings):
+	config = createConfig(settings.batch_size)
+	return [ModelWorker(config, settings) for _ in range(settings.sessions)]
+
 @application.before_first_request
 def load_model():
 	global cfg
-	global _model
-	model_folder_path = os.path.abspath("./") + "/mrcnn"
-	weights_path= os.path.join(WEIGHTS_FOLDER, WEIGHTS_FILE_NAME)
-	cfg=PredictionConfig()
-	print(cfg.IMAGE_RESIZE_MODE)
-	print('==============before loading model=========')
-	_model = MaskRCNN(mode='inference', model_dir=model_folder_path,config=cfg)
-	print('=================after loading model==============')
-	_model.load_weights(weights_path, by_name=True)
-	global _graph
-	_graph = tf.get_default_graph()
+	global _pool
+	global _tuning
+	if _pool is not None:
+		return
+
+	settings = autotune.DEFAULT_SETTINGS
+	if AUTOTUNE:
+		logger.info('tuning session layout')
+		_tuning = autotune.load_or_tune(AUTOTUNE_FOLDER, createWorkers, AUTOTUNE_LATENCY_TARGET)
+		settings = _tuning.best
+
+	cfg=createConfig(settings.batch_size)
+	logger.info('image resize mode %s', cfg.IMAGE_RESIZE_MODE)
+	logger.info('loading model')
+	_pool = ModelPool(createWorkers(settings))
+	logger.info('model loaded')
 
 
 def myImageLoader(imageInput):
@@ -83,87 +294,188 @@ def myImageLoader(imageInput):
 	h,w,c=image.shape 
 	return image,w,h
 
-def getClassNames(classIds):
-	result=list()
-	for classid in classIds:
-		data={}
-		if classid==1:
-			data['name']='wall'
-		if classid==2:
-			data['name']='window'
-		if classid==3:
-			data['name']='door'
-		result.append(data)	
-
-	return result				
-def normalizePoints(bbx,classNames):
-	normalizingX=1
-	normalizingY=1
-	result=list()
-	doorCount=0
-	index=-1
-	doorDifference=0
-	for bb in bbx:
-		index=index+1
-		if(classNames[index]==3):
-			doorCount=doorCount+1
-			if(abs(bb[3]-bb[1])>abs(bb[2]-bb[0])):
-				doorDifference=doorDifference+abs(bb[3]-bb[1])
-			else:
-				doorDifference=doorDifference+abs(bb[2]-bb[0])
-
-
-		result.append([bb[0]*normalizingY,bb[1]*normalizingX,bb[2]*normalizingY,bb[3]*normalizingX])
-	return result,(doorDifference/doorCount)	
-		
-
-def turnSubArraysToJson(objectsArr):
-	result=list()
-	for obj in objectsArr:
-		data={}
-		data['x1']=obj[1]
-		data['y1']=obj[0]
-		data['x2']=obj[3]
-		data['y2']=obj[2]
-		result.append(data)
-	return result
-
-
-
 @application.route('/',methods=['POST'])
 def prediction():
-	global cfg
-	imagefile = PIL.Image.open(request.files['image'].stream)
-	image,w,h=myImageLoader(imagefile)
-	print(h,w)
-	scaled_image = mold_image(image, cfg)
-	sample = expand_dims(scaled_image, 0)
-
-	global _model
-	global _graph
-	with _graph.as_default():
-		r = _model.detect(sample, verbose=0)[0]
+	trace = metrics.begin_request()
+	profile = _profiler.begin() if _profiler.should_sample() else None
+	try:
+		response = predictionStages()
+	except memory.MemoryBudgetExceeded:
+		metrics.count(metrics.REQUESTS, label_value="rejected")
+		raise
+	except Exception:
+		metrics.count(metrics.REQUESTS, label_value="error")
+		raise
+	finally:
+		metrics.end_request()
+		if profile is not None:
+			tag = '%s-%sx%s' % (trace.details.get('image_hash', 'unknown'), trace.details.get('width', 0), trace.details.get('height', 0))
+			path = _profiler.finish(profile, tag, trace.stages, trace.details)
+			logger.info('request profile written to %s', path)
+
+	metrics.count(metrics.REQUESTS, label_value="ok")
+	response.headers['Server-Timing'] = trace.server_timing()
+	response.headers['Timing-Allow-Origin'] = '*'
+
+	# Opt-in stage timeline, sent as a JSON header next to the model
+	if isDebugRequest():
+		response.headers['X-Stage-Breakdown'] = json.dumps(trace.breakdown(), separators=(',', ':'))
+	return response
+
+def geometryOptions():
+	lod = request.args.get('lod', request.form.get('lod', ''))
+	if lod in ('low', 'msft'):
+		return replace(GEOMETRY_OPTIONS, lod=lod)
+	return GEOMETRY_OPTIONS
+
+def isDebugRequest():
+	value = request.args.get('debug', request.form.get('debug', ''))
+	return value.lower() in ('1', 'true', 'yes')
+
+def isJsonRequest():
+	return request.args.get('format', request.form.get('format', '')).lower() == 'json'
+
+def isSessionRequest():
+	value = request.args.get('session', request.form.get('session', ''))
+	return value.lower() in ('1', 'true', 'yes')
+
+def predictionStages():
+	# Opening only reads the header, the size is known before the pixels are decoded
+	with metrics.stage("open"):
+		imagefile = PIL.Image.open(request.files['image'].stream)
+	width, height = imagefile.size
+
+	reservation = _budget.acquire(_budget.estimate(width, height, _memory.peak_per_pixel(width, height)))
+	try:
+		requestMemory = _memory.begin(width, height) if _memory.enabled else None
+		response = predictImage(imagefile, requestMemory)
+		if requestMemory is not None:
+			_memory.finish(requestMemory, metrics.current_trace().memory)
+	except BaseException:
+		_budget.release(reservation)
+		raise
+
+	# The geometry buffers stay alive until the streamed body is sent
+	response.call_on_close(lambda: _budget.release(reservation))
+	return response
+
+def predictImage(imagefile, requestMemory):
+	with metrics.stage("decode"):
+		image,w,h=myImageLoader(imagefile)
+	logger.debug('image size %d x %d', w, h)
+	trace = metrics.current_trace()
+	trace.annotate('width', w)
+	trace.annotate('height', h)
+	if profiling.current():
+		trace.annotate('image_hash', hashlib.sha1(numpy.ascontiguousarray(image)).hexdigest()[:16])
+	with metrics.stage("mold"):
+		scaled_image = mold_image(image, cfg)
+
+	r = _pool.detect(scaled_image)
+	if requestMemory is not None:
+		requestMemory.checkpoint()
 	
 	#output_data = model_api(imagefile)
 	
-	data={}
-	bbx=r['rois'].tolist()
-	temp,averageDoor=normalizePoints(bbx,r['class_ids'])
-	temp=turnSubArraysToJson(temp)
-	data['points']=temp
-	data['classes']=getClassNames(r['class_ids'])
-	data['Width']=w
-	data['Height']=h
-	data['averageDoor']=averageDoor
-
-	gltf = build_3d_model(data)
-	bytes = BytesIO()
-	gltf.write_glb(bytes)
-	bytes.seek(0)
-	return send_file(bytes, mimetype="model/gltf-binary")
+	detections = Detections.from_rois(r['rois'], r['class_ids'], r['scores'], w, h)
+	if isJsonRequest():
+		return jsonify(detections.to_json())
+	if not isSessionRequest():
+		return glbResponse(build_3d_model(detections, geometryOptions()))
+
+	session = GeometrySession.from_detections(detections, geometryOptions())
+	with metrics.stage("mesh_build"):
+		gltf = session.build()
+	response = glbResponse(gltf)
+	response.headers['X-Session-Id'] = _sessions.add(session)
+	return response
+
+def glbResponse(gltf):
+	# Only the JSON is written here, the geometry is copied slice by slice while the response is sent
+	with metrics.stage("glb_write"):
+		body = GLBStream(gltf)
+	metrics.count(metrics.BYTES_OUT, len(body), name="bytes")
+	response = Response(body, mimetype="model/gltf-binary", direct_passthrough=True)
+	response.content_length = len(body)
+	return response
+
+@application.route('/sessions/<sessionId>/edits',methods=['POST'])
+def sessionEdits(sessionId):
+	"""Applies {"edits": [...]} to a session, answers with the whole model or with "patch": "nodes" only the changed nodes"""
+	entry = _sessions.get(sessionId)
+	if entry is None:
+		return jsonify({'error': 'unknown session %s' % sessionId}), 404
+
+	body = request.get_json(silent=True) or {}
+	edits = body.get('edits')
+	patch = body.get('patch', 'full')
+	if not isinstance(edits, list) or not all(isinstance(edit, dict) for edit in edits) or patch not in ('full', 'nodes'):
+		return jsonify({'error': 'expected {"edits": [...], "patch": "full" | "nodes"}'}), 400
+
+	lock, session = entry
+	with lock:
+		try:
+			with metrics.stage("session_edit"):
+				changed, removed = session.apply(edits)
+		except ValueError as error:
+			return jsonify({'error': str(error)}), 400
+
+		try:
+			with metrics.stage("mesh_build"):
+				gltf = session.build(changed if patch == 'nodes' else None)
+		except Exception:
+			# A session that can not be built would fail every later edit as well
+			_sessions.remove(sessionId)
+			raise
+
+	response = glbResponse(gltf)
+	response.headers['X-Changed-Nodes'] = ','.join(changed)
+	response.headers['X-Removed-Nodes'] = ','.join(removed)
+	return response
+
+@application.route('/sessions/<sessionId>',methods=['DELETE'])
+def sessionClose(sessionId):
+	if not _sessions.remove(sessionId):
+		return jsonify({'error': 'unknown session %s' % sessionId}), 404
+	return Response(status=204)
+
+@application.errorhandler(memory.MemoryBudgetExceeded)
+def memoryBudgetExceeded(error):
+	response = jsonify({'error': str(error)})
+	response.status_code = 503
+	response.headers['Retry-After'] = '5'
+	return response
+
+@application.route('/metrics',methods=['GET'])
+def metricsReport():
+	return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@application.route('/admin/autotune',methods=['GET'])
+def autotuneReport():
+	if _tuning is None:
+		return jsonify({
+			'enabled': AUTOTUNE,
+			'loaded': _pool is not None,
+			'host': autotune.host_key(),
+			'settings': asdict(autotune.DEFAULT_SETTINGS),
+		})
+
+	report = _tuning.to_json()
+	report['enabled'] = AUTOTUNE
+	return jsonify(report)
+
+@application.route('/admin/memory',methods=['GET'])
+def memoryReport():
+	return jsonify({
+		'tracking': _memory.enabled,
+		'budget': _budget.report(),
+		'classes': _memory.report(),
+	})
     
 if __name__ =='__main__':
 	application.debug=True
-	print('===========before running==========')
+	if AUTOTUNE:
+		load_model()
+	logger.info('starting server')
 	application.run(host="0.0.0.0", port=8081)
-	print('===========after running==========')
+	logger.info('server stopped')
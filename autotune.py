@@ -0,0 +1,233 @@
+"""
+Startup tuning of the inference session layout.
+
+A candidate setting describes how the host CPUs are split between model
+sessions: the number of independent sessions (each with its own graph and
+weights), the intra-op and inter-op thread pool sizes of every session and the
+batch size the model is built with. Every candidate is measured by pushing
+synthetic floor plans through `detect` and the fastest setting that keeps the
+p95 latency under the declared target is persisted per host type.
+"""
+
+import json
+import math
+import os
+import platform
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable
+import numpy as np
+
+@dataclass(frozen=True)
+class SessionSettings:
+    intra_op_threads: int
+    inter_op_threads: int
+    sessions: int
+    batch_size: int
+
+@dataclass
+class TrialResult:
+    settings: SessionSettings
+    throughput: float
+    # None for failed trials, which have no latencies
+    p95_latency: "float | None"
+    mean_latency: "float | None"
+    error: "str | None" = None
+
+@dataclass
+class TuningReport:
+    host: str
+    latency_target: float
+    best: SessionSettings
+    trials: "list[TrialResult]" = field(default_factory=list)
+    created: float = field(default_factory=time.time)
+
+    def to_json(self):
+        return asdict(self)
+
+    @staticmethod
+    def from_json(data: dict):
+        trials = []
+        for trial in data["trials"]:
+            trial = dict(trial)
+            trial["settings"] = SessionSettings(**trial["settings"])
+            # Earlier reports stored failed trials with infinite latencies, which is not valid JSON
+            for key in ("p95_latency", "mean_latency"):
+                if trial[key] is not None and not math.isfinite(trial[key]):
+                    trial[key] = None
+            trials.append(TrialResult(**trial))
+
+        return TuningReport(
+            host=data["host"],
+            latency_target=data["latency_target"],
+            best=SessionSettings(**data["best"]),
+            trials=trials,
+            created=data["created"],
+        )
+
+# Equivalent to the TensorFlow defaults: one session, thread pools sized by the runtime
+DEFAULT_SETTINGS = SessionSettings(intra_op_threads=0, inter_op_threads=0, sessions=1, batch_size=1)
+
+def host_key():
+    cpu_count = os.cpu_count() or 1
+    model = platform.processor() or "unknown"
+
+    try:
+        with open("/proc/cpuinfo", "rt") as file:
+            for line in file:
+                if line.startswith("model name"):
+                    model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+
+    key = f"{platform.machine()}-{model}-{cpu_count}cpu"
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", key)
+
+def candidate_grid(cpu_count: int, batch_sizes: "tuple[int, ...]" = (1, 2)):
+    candidates: "list[SessionSettings]" = []
+
+    for sessions in (1, 2, 4):
+        if sessions > cpu_count:
+            continue
+
+        threads = max(1, cpu_count // sessions)
+        for intra_op_threads in sorted({threads, max(1, threads // 2)}):
+            for inter_op_threads in (1, 2):
+                for batch_size in batch_sizes:
+                    candidates.append(SessionSettings(intra_op_threads, inter_op_threads, sessions, batch_size))
+
+    return candidates
+
+def synthetic_images(count: int, width: int = 1024, height: int = 768, seed: int = 0):
+    # White canvas with dark axis aligned strokes, close enough to a floor plan to exercise the detection heads
+    rng = np.random.default_rng(seed)
+    images = []
+
+    for _ in range(count):
+        image = np.full((height, width, 3), 255, dtype=np.uint8)
+        for _ in range(40):
+            x, y = rng.integers(0, width - 1), rng.integers(0, height - 1)
+            length, thickness = rng.integers(40, 400), rng.integers(4, 14)
+            if rng.random() < 0.5:
+                image[y:y + thickness, x:x + length] = 0
+            else:
+                image[y:y + length, x:x + thickness] = 0
+        images.append(image)
+
+    return images
+
+def run_trial(workers: list, settings: SessionSettings, images: "list[np.ndarray]", rounds: int = 4, warmup: int = 1):
+    """
+    Runs `rounds` batches through every worker concurrently, workers are the
+    sessions created for `settings` and need to provide `detect(images)`.
+    """
+
+    batches = [
+        [images[(i * settings.batch_size + j) % len(images)] for j in range(settings.batch_size)]
+        for i in range(rounds + warmup)
+    ]
+    latencies: "list[float]" = []
+    lock = threading.Lock()
+
+    def run(worker):
+        for batch in batches[:warmup]:
+            worker.detect(batch)
+
+        for batch in batches[warmup:]:
+            start = time.perf_counter()
+            worker.detect(batch)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.perf_counter() - start
+
+    if len(latencies) != rounds * len(workers):
+        return TrialResult(settings, 0.0, None, None, error="Worker failed")
+
+    image_count = rounds * len(workers) * settings.batch_size
+    return TrialResult(
+        settings,
+        throughput=image_count / total,
+        p95_latency=float(np.percentile(latencies, 95)),
+        mean_latency=float(np.mean(latencies)),
+    )
+
+def select_best(trials: "list[TrialResult]", latency_target: float):
+    valid = [trial for trial in trials if trial.error is None]
+    if not valid:
+        return DEFAULT_SETTINGS
+
+    within_target = [trial for trial in valid if trial.p95_latency <= latency_target]
+    if within_target:
+        return max(within_target, key=lambda trial: trial.throughput).settings
+
+    # Nothing meets the target, get as close to it as possible
+    return min(valid, key=lambda trial: trial.p95_latency).settings
+
+def tune(create_workers: "Callable[[SessionSettings], list]", latency_target: float, candidates: "list[SessionSettings] | None" = None, rounds: int = 4):
+    if candidates is None:
+        candidates = candidate_grid(os.cpu_count() or 1)
+
+    images = synthetic_images(4)
+    trials: "list[TrialResult]" = []
+
+    for settings in candidates:
+        try:
+            workers = create_workers(settings)
+        except Exception as error:
+            trials.append(TrialResult(settings, 0.0, None, None, error=repr(error)))
+            continue
+
+        try:
+            trials.append(run_trial(workers, settings, images, rounds=rounds))
+        finally:
+            for worker in workers:
+                worker.close()
+
+    return TuningReport(
+        host=host_key(),
+        latency_target=latency_target,
+        best=select_best(trials, latency_target),
+        trials=trials,
+    )
+
+def report_path(folder: str):
+    return os.path.join(folder, host_key() + ".json")
+
+def load_report(folder: str, latency_target: float):
+    path = report_path(folder)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rt") as file:
+        report = TuningReport.from_json(json.load(file))
+
+    # Results tuned for another latency target can still be reused, the selection is recomputed
+    if report.latency_target != latency_target:
+        report.latency_target = latency_target
+        report.best = select_best(report.trials, latency_target)
+
+    return report
+
+def save_report(folder: str, report: TuningReport):
+    os.makedirs(folder, exist_ok=True)
+    with open(report_path(folder), "wt") as file:
+        json.dump(report.to_json(), file, indent=2)
+
+def load_or_tune(folder: str, create_workers: "Callable[[SessionSettings], list]", latency_target: float):
+    report = load_report(folder, latency_target)
+    if report is None:
+        report = tune(create_workers, latency_target)
+        save_report(folder, report)
+
+    return report
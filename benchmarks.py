@@ -0,0 +1,417 @@
+"""
+Benchmarks of the geometry stages on synthetic floor plans.
+
+Usage: python benchmarks.py [name ...], runs every benchmark without arguments.
+"""
+
+import io
+import random
+import time
+import tracemalloc
+import numpy as np
+from sys import argv
+from typing import Callable
+from gltflib import ComponentType
+import meshopt
+from glb import GLBStream
+from build_3d_model import (MERGE_TOLERANCE, ROOM_TOLERANCE, SNAP_TOLERANCE, TYPE_CODES, WALL, Detections, GeometryOptions, WallTable, align_walls, analyze_plan,
+                            build_3d_model, build_geometry, find_rooms, merge_walls, snap_walls)
+from session import GeometrySession
+
+def synthetic_plan(columns: int, rows: int, cell: float = 200.0, thickness: float = 10.0, jitter: float = 2.0, seed: int = 0):
+    """
+    Detections of a grid of `columns` x `rows` rooms, horizontal walls are
+    randomly split by a door or a window.
+    """
+
+    rng = random.Random(seed)
+    points = []
+    classes = []
+
+    def add(x1: float, y1: float, x2: float, y2: float, name: str):
+        points.append((
+            x1 + rng.uniform(-jitter, jitter),
+            y1 + rng.uniform(-jitter, jitter),
+            x2 + rng.uniform(-jitter, jitter),
+            y2 + rng.uniform(-jitter, jitter),
+        ))
+        classes.append(TYPE_CODES[name])
+
+    for row in range(rows + 1):
+        y = row * cell
+        for column in range(columns):
+            x = column * cell
+            if rng.random() < 0.5:
+                opening = cell * 0.2
+                add(x, y - thickness / 2, x + cell * 0.3, y + thickness / 2, "wall")
+                add(x + cell * 0.3, y - thickness / 2, x + cell * 0.3 + opening, y + thickness / 2, rng.choice(["door", "window"]))
+                add(x + cell * 0.3 + opening, y - thickness / 2, x + cell, y + thickness / 2, "wall")
+            else:
+                add(x, y - thickness / 2, x + cell, y + thickness / 2, "wall")
+
+    for column in range(columns + 1):
+        x = column * cell
+        for row in range(rows):
+            y = row * cell
+            add(x - thickness / 2, y, x + thickness / 2, y + cell, "wall")
+
+    boxes = np.array(points, dtype=np.float32).reshape(-1, 4)
+    return Detections(boxes, np.array(classes, dtype=np.int8), None, int(columns * cell), int(rows * cell), cell * 0.2)
+
+def timed(setup: Callable, function: Callable, repeat: int = 3):
+    """Best time of `repeat` runs of `function(setup())`"""
+    best = float("inf")
+    for _ in range(repeat):
+        value = setup()
+        start = time.perf_counter()
+        function(value)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def print_table(header: "list[str]", rows: "list[list]"):
+    print(" | ".join(f"{name:>12}" for name in header))
+    for row in rows:
+        print(" | ".join(f"{value:>12.4g}" if isinstance(value, float) else f"{value:>12}" for value in row))
+
+def bench_align_walls():
+    rows = []
+    for size in (4, 8, 16, 32, 64):
+        detections = synthetic_plan(size, size)
+        seconds = timed(lambda: detections.walls(), align_walls)
+        walls = len(detections)
+        rows.append([walls, seconds, seconds / walls * 1e6])
+
+    print_table(["walls", "seconds", "us/wall"], rows)
+
+def bench_find_rooms():
+    rows = []
+    for size in (4, 8, 16, 32, 64, 96):
+        detections = synthetic_plan(size, size)
+        walls = detections.walls()
+        align_walls(walls)
+        walls.normalize(1 / (detections.average_door / 0.8))
+        seconds = timed(walls.copy, lambda walls: find_rooms(walls, tolerance=0.05))
+        rows.append([len(walls), seconds, seconds / len(walls) * 1e6])
+
+    print_table(["walls", "seconds", "us/wall"], rows)
+
+def bench_snap_walls():
+    rows = []
+    for size in (8, 16, 32):
+        for jitter in (2.0, 6.0):
+            detections = synthetic_plan(size, size, jitter=jitter)
+            pixels_per_unit = detections.average_door / 0.8
+            row = [len(detections), jitter]
+
+            for snap in (False, True):
+                walls = detections.walls()
+                if snap:
+                    report = snap_walls(walls, SNAP_TOLERANCE * detections.average_door, ROOM_TOLERANCE * pixels_per_unit)
+                    row[2:2] = [report["x_lines_before"] + report["y_lines_before"], report["x_lines_after"] + report["y_lines_after"]]
+                align_walls(walls)
+                walls.normalize(1 / pixels_per_unit)
+
+                start = time.perf_counter()
+                rooms = find_rooms(walls, tolerance=ROOM_TOLERANCE)
+                row += [sum(len(quads) for quads in rooms.values()), time.perf_counter() - start]
+
+            rows.append(row)
+
+    print_table(["walls", "jitter", "lines", "snapped", "quads", "seconds", "snap quads", "snap seconds"], rows)
+
+def bench_merge_walls():
+    rows = []
+    for size in (8, 16, 32, 64, 96):
+        detections = synthetic_plan(size, size)
+        walls = detections.walls()
+        align_walls(walls)
+        walls.normalize(1 / (detections.average_door / 0.8))
+
+        seconds = timed(walls.copy, lambda walls: merge_walls(walls, MERGE_TOLERANCE))
+        _, report = merge_walls(walls, MERGE_TOLERANCE)
+        rows.append([len(walls), report["boxes_after"], report["merged"], report["trimmed"], seconds])
+
+    print_table(["walls", "boxes", "merged", "trimmed", "seconds"], rows)
+
+def bench_build_geometry():
+    rows = []
+    for size in (8, 16, 32):
+        detections = synthetic_plan(size, size)
+        walls = detections.walls()
+        align_walls(walls)
+        walls.normalize(1 / (detections.average_door / 0.8))
+        walls, _ = merge_walls(walls, MERGE_TOLERANCE)
+        rooms = find_rooms(walls, ROOM_TOLERANCE)
+
+        row = [len(walls)]
+        for hide_faces in (False, True):
+            options = GeometryOptions(hide_faces=hide_faces)
+            seconds = timed(lambda: None, lambda _: build_geometry(walls, rooms, options))
+            gltf = build_geometry(walls, rooms, options)
+            accessors = gltf.model.accessors
+            triangles = sum(accessors[primitive.indices].count // 3 for mesh in gltf.model.meshes for primitive in mesh.primitives)
+            row += [triangles, seconds]
+        rows.append(row)
+
+    print_table(["boxes", "triangles", "seconds", "hidden tris", "hidden secs"], rows)
+
+def bench_glb_write():
+    rows = []
+    for size in (8, 16, 32):
+        detections = synthetic_plan(size, size)
+        walls = detections.walls()
+        align_walls(walls)
+        walls.normalize(1 / (detections.average_door / 0.8))
+        walls, _ = merge_walls(walls, MERGE_TOLERANCE)
+        rooms = find_rooms(walls, ROOM_TOLERANCE)
+
+        row = [len(walls)]
+        for packed in (False, True):
+            gltf = build_geometry(walls, rooms, GeometryOptions(packed=packed))
+            stream = io.BytesIO()
+            gltf.write_glb(stream)
+            row += [timed(lambda: None, lambda _: gltf.write_glb(io.BytesIO())), stream.tell()]
+        rows.append(row)
+
+    print_table(["boxes", "seconds", "bytes", "packed secs", "packed bytes"], rows)
+
+def bench_instancing():
+    rows = []
+    for size in (8, 16, 32):
+        detections = synthetic_plan(size, size)
+        row = [len(detections)]
+        for instancing in (None, "nodes", "ext"):
+            options = GeometryOptions(instancing=instancing)
+            seconds = timed(lambda: None, lambda _: build_3d_model(detections, options))
+            stream = io.BytesIO()
+            build_3d_model(detections, options).write_glb(stream)
+            row += [seconds, stream.tell()]
+        rows.append(row)
+
+    print_table(["walls", "baked secs", "baked bytes", "nodes secs", "nodes bytes", "ext secs", "ext bytes"], rows)
+
+def bench_consolidate():
+    rows = []
+    for size in (8, 16, 32, 64):
+        detections = synthetic_plan(size, size)
+        row = [len(detections)]
+        for consolidate in (False, True):
+            options = GeometryOptions(consolidate=consolidate)
+            seconds = timed(lambda: None, lambda _: build_3d_model(detections, options))
+            gltf = build_3d_model(detections, options)
+            stream = io.BytesIO()
+            gltf.write_glb(stream)
+            row += [len(gltf.model.meshes), seconds, stream.tell()]
+        rows.append(row)
+
+    print_table(["walls", "meshes", "seconds", "bytes", "merged", "merged secs", "merged bytes"], rows)
+
+def bench_compression():
+    rows = []
+    for size in (8, 16, 32):
+        detections = synthetic_plan(size, size)
+        for quantize, compress in ((False, False), (True, False), (False, True), (True, True)):
+            options = GeometryOptions(consolidate=True, quantize=quantize, compress=compress)
+            seconds = timed(lambda: None, lambda _: build_3d_model(detections, options))
+            gltf = build_3d_model(detections, options)
+            stream = io.BytesIO()
+            gltf.write_glb(stream)
+            rows.append([len(detections), str(quantize), str(compress), stream.tell(), seconds])
+
+    print_table(["walls", "quantize", "compress", "bytes", "seconds"], rows)
+
+    # Codec throughput on the views of the quantized model
+    rows = []
+    for size in (16, 32, 64):
+        gltf = build_3d_model(synthetic_plan(size, size), GeometryOptions(consolidate=True, quantize=True))
+        data = gltf.resources[0].data
+        types = {accessor.bufferView: accessor.componentType for accessor in gltf.model.accessors}
+        for index, view in enumerate(gltf.model.bufferViews):
+            raw = data[view.byteOffset:view.byteOffset + view.byteLength]
+            if view.byteStride:
+                vertices = np.frombuffer(raw, dtype=np.uint8).reshape(-1, view.byteStride)
+                encode = lambda: meshopt.encode_vertex_buffer(vertices)
+                decode = lambda encoded: meshopt.decode_vertex_buffer(encoded, len(vertices), view.byteStride)
+                name = f"vertex/{view.byteStride}"
+            else:
+                indices = np.frombuffer(raw, dtype=np.uint32 if types[index] == ComponentType.UNSIGNED_INT.value else np.uint16)
+                encode = lambda: meshopt.encode_index_sequence(indices)
+                decode = lambda encoded: meshopt.decode_index_sequence(encoded, len(indices))
+                name = f"index/{indices.itemsize}"
+
+            encoded = encode()
+            encode_seconds = timed(lambda: None, lambda _: encode())
+            decode_seconds = timed(lambda: None, lambda _: decode(encoded), repeat=1)
+            rows.append([size, name, len(raw), len(raw) / len(encoded), len(raw) / encode_seconds / 1e6, len(raw) / decode_seconds / 1e6])
+
+    print_table(["plan", "view", "bytes", "ratio", "encode MB/s", "decode MB/s"], rows)
+
+def bench_glb_stream():
+    def measure(write: Callable):
+        """Seconds to the first written bytes, in total and the peak traced memory of `write(send)`"""
+        start = time.perf_counter()
+        first = []
+
+        def send(chunk: bytes):
+            if not first:
+                first.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        write(send)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return first[0], time.perf_counter() - start, peak
+
+    def buffered(gltf):
+        def write(send: Callable):
+            stream = io.BytesIO()
+            gltf.write_glb(stream)
+            send(stream.getvalue())
+        return write
+
+    def streamed(gltf):
+        def write(send: Callable):
+            for chunk in GLBStream(gltf):
+                send(chunk)
+        return write
+
+    rows = []
+    for size in (16, 32, 64):
+        gltf = build_3d_model(synthetic_plan(size, size))
+        geometry = gltf.resources[0].data.nbytes
+        row = [geometry]
+        for write in (buffered, streamed):
+            row += measure(write(gltf))
+        rows.append(row)
+
+    print_table(["geometry", "first byte", "seconds", "peak", "stream first", "stream secs", "stream peak"], rows)
+
+def node_bounds(model, index: int):
+    """Bounds of a node from the extras of a hierarchy node or its position accessor and transform"""
+    node = model.nodes[index]
+    if node.children:
+        return np.array(node.extras["min"]), np.array(node.extras["max"])
+
+    accessor = model.accessors[model.meshes[node.mesh].primitives[0].attributes.POSITION]
+    scale = np.array(node.scale or [1, 1, 1])
+    translation = np.array(node.translation or [0, 0, 0])
+    return translation + scale * np.array(accessor.min), translation + scale * np.array(accessor.max)
+
+def bench_hierarchy():
+    def picks(model, points: np.ndarray):
+        """Bounds tested per point to find the leaf nodes containing it"""
+        bounds = [node_bounds(model, index) for index in range(len(model.nodes))]
+        tests = 0
+        for point in points:
+            stack = list(model.scenes[0].nodes)
+            while stack:
+                index = stack.pop()
+                tests += 1
+                low, high = bounds[index]
+                if (low <= point).all() and (point <= high).all() and model.nodes[index].children:
+                    stack.extend(model.nodes[index].children)
+        return tests / len(points)
+
+    rows = []
+    rng = np.random.default_rng(0)
+    for size in (8, 16, 32, 64):
+        detections = synthetic_plan(size, size)
+        row = [len(detections)]
+        points = None
+        for hierarchy in (False, True):
+            options = GeometryOptions(hierarchy=hierarchy)
+            seconds = timed(lambda: None, lambda _: build_3d_model(detections, options))
+            model = build_3d_model(detections, options).model
+            if points is None:
+                bounds = [node_bounds(model, index) for index in range(len(model.nodes))]
+                low = np.min([low for low, _ in bounds], axis=0)
+                high = np.max([high for _, high in bounds], axis=0)
+                points = rng.uniform(low, high, (200, 3))
+            row += [len(model.scenes[0].nodes), seconds, picks(model, points)]
+        rows.append(row)
+
+    print_table(["walls", "roots", "seconds", "tests/pick", "bvh roots", "bvh seconds", "bvh tests"], rows)
+
+def bench_lod():
+    rows = []
+    for size in (8, 16, 32):
+        detections = synthetic_plan(size, size)
+        row = [len(detections)]
+        for lod in (None, "msft", "low"):
+            options = GeometryOptions(lod=lod)
+            seconds = timed(lambda: None, lambda _: build_3d_model(detections, options))
+            model = build_3d_model(detections, options).model
+            triangles = sum(model.accessors[mesh.primitives[0].indices].count // 3 for mesh in model.meshes)
+            row += [seconds, triangles]
+        rows.append(row)
+
+    print_table(["walls", "seconds", "triangles", "msft secs", "msft tris", "low secs", "low tris"], rows)
+
+def check_hidden_element():
+    """A wall inside another one has no faces left, sessions must build without its node before and after edits"""
+    walls = WallTable([0, 0, 0, 4, 1], [0, 4, 0, 0, 0], [4, 4, 0.2, 4.2, 1.5], [0.2, 4.2, 4, 4.2, 0.1], [WALL] * 5)
+    session = GeometrySession(walls, {}, GeometryOptions(hide_faces=True))
+    if "Wall_4" in [node.name for node in session.build().model.nodes]:
+        raise RuntimeError("The hidden Wall_4 has a node")
+    changed, _ = session.apply([{"op": "move", "id": 4, "dx": 0.0, "dy": 0.5}])
+    if "Wall_4" not in changed:
+        raise RuntimeError(f"Wall_4 moved out of Wall_0 is not changed: {changed}")
+    _, removed = session.apply([{"op": "move", "id": 4, "dx": 0.0, "dy": -0.5}])
+    if "Wall_4" not in removed:
+        raise RuntimeError(f"Wall_4 moved back into Wall_0 is not removed: {removed}")
+    session.build()
+
+def bench_session():
+    check_hidden_element()
+    rows = []
+    for size in (8, 16, 32):
+        walls, rooms = analyze_plan(synthetic_plan(size, size))
+        build_seconds = timed(lambda: None, lambda _: build_geometry(walls, rooms, GeometryOptions(hide_faces=True)))
+        session = GeometrySession(walls, rooms, GeometryOptions(hide_faces=True))
+
+        # Moves a door or window along its wall, then deletes a wall and adds it back
+        opening = int(np.flatnonzero(walls.type != WALL)[len(walls) // 4 % np.count_nonzero(walls.type != WALL)])
+        move_seconds = timed(lambda: None, lambda _: session.apply([{"op": "move", "id": opening, "dx": 0.01, "dy": 0.0}]))
+        changed, _ = session.apply([{"op": "move", "id": opening, "dx": 0.01, "dy": 0.0}])
+        patch_seconds = timed(lambda: None, lambda _: session.build(changed))
+
+        def replace_wall(_):
+            index = int(np.flatnonzero(session.alive & (session.walls.type == WALL))[len(walls) // 2])
+            x1, y1, x2, y2 = session._bounds(index)
+            session.apply([{"op": "delete", "id": index}, {"op": "add", "type": "wall", "x1": x1, "y1": y1, "x2": x2, "y2": y2}])
+        replace_seconds = timed(lambda: None, replace_wall)
+        rows.append([len(walls), build_seconds, move_seconds, patch_seconds, replace_seconds])
+
+    print_table(["boxes", "full build secs", "move secs", "patch build secs", "delete+add secs"], rows)
+
+def bench_build_3d_model():
+    rows = []
+    for size in (4, 8, 16):
+        detections = synthetic_plan(size, size)
+        seconds = timed(lambda: detections, build_3d_model)
+        walls = len(detections)
+        rows.append([walls, seconds, seconds / walls * 1e6])
+
+    print_table(["walls", "seconds", "us/wall"], rows)
+
+BENCHMARKS = {
+    "align_walls": bench_align_walls,
+    "find_rooms": bench_find_rooms,
+    "snap_walls": bench_snap_walls,
+    "merge_walls": bench_merge_walls,
+    "build_geometry": bench_build_geometry,
+    "glb_write": bench_glb_write,
+    "instancing": bench_instancing,
+    "consolidate": bench_consolidate,
+    "compression": bench_compression,
+    "glb_stream": bench_glb_stream,
+    "hierarchy": bench_hierarchy,
+    "lod": bench_lod,
+    "session": bench_session,
+    "build_3d_model": bench_build_3d_model,
+}
+
+if __name__ == "__main__":
+    for name in argv[1:] or list(BENCHMARKS):
+        print(f"== {name}")
+        BENCHMARKS[name]()
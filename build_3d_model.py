@@ -1,10 +1,15 @@
 from bisect import bisect_left
+from dataclasses import dataclass
 from json import loads
 from sys import argv
-from typing import Any
-from dataclasses import dataclass, field
+from typing import Callable
+import logging
+import math
 import numpy as np
-from MeshBuilder import MeshBuilder
+from MeshBuilder import MeshBuilder, cube_quads, visible_faces
+import metrics
+
+logger = logging.getLogger(__name__)
 
 """
 Directions:
@@ -14,52 +19,117 @@ Directions:
   3 -> LEFT
 """
 
-@dataclass(eq=False)
-class Wall:
-    x1: float
-    y1: float
-    x2: float
-    y2: float
+# Type codes of the detected elements, same as the class ids of the model
+WALL = 1
+WINDOW = 2
+DOOR = 3
 
-    type: str
+# Edges closer than this fraction of the average door width are snapped together
+SNAP_TOLERANCE = 0.1
+# Grid lines of find_rooms closer than this, in model units
+ROOM_TOLERANCE = 0.05
+# Gap up to which collinear boxes are merged and opening overlaps are trimmed, in model units
+MERGE_TOLERANCE = 0.01
+# Height of walls and openings, in model units
+WALL_HEIGHT = 2.6
 
-    group: "set[Wall] | None" = None
+TYPE_NAMES = {WALL: "wall", WINDOW: "window", DOOR: "door"}
+TYPE_CODES = {name: code for code, name in TYPE_NAMES.items()}
 
-    def get_width(self):
+@dataclass
+class GeometryOptions:
+    """
+    Output modes of the generated model.
+
+    hide_faces: leave out faces where element boxes touch or overlap, about
+        17% fewer triangles for about 2.3 times the mesh building time, partly
+        hidden faces are only clipped when a single rectangle is left
+    packed: write all meshes into one binary buffer
+    instancing: None for baked boxes, "ext" for one EXT_mesh_gpu_instancing
+        node per kind of box or "nodes" for a scaled node per box, both
+        share a unit cube mesh per kind
+    consolidate: bake one mesh per category (rooms, floors, walls, doors,
+        windows) instead of one per element, the index range of every
+        element is listed in the node extras
+    quantize: store mesh positions as uint16 (KHR_mesh_quantization)
+    compress: compress the buffer views (EXT_meshopt_compression)
+    hierarchy: group the nodes under a bounding volume hierarchy
+    lod: None for the full detail only, "msft" to add a low detail level
+        linked through MSFT_lod or "low" for the low detail level only, see
+        `add_low_detail`
+    """
+
+    hide_faces: bool = False
+    packed: bool = True
+    instancing: "str | None" = None
+    consolidate: bool = False
+    quantize: bool = False
+    compress: bool = False
+    hierarchy: bool = False
+    lod: "str | None" = None
+
+    @staticmethod
+    def from_environment(environment: "dict[str, str]"):
+        """Options from the FLOORPLAN_* variables, see the readme"""
+        return GeometryOptions(
+            hide_faces=environment.get("FLOORPLAN_HIDE_FACES", "0") == "1",
+            instancing=environment.get("FLOORPLAN_INSTANCING") or None,
+            consolidate=environment.get("FLOORPLAN_CONSOLIDATE", "0") == "1",
+            quantize=environment.get("FLOORPLAN_QUANTIZE", "0") == "1",
+            compress=environment.get("FLOORPLAN_COMPRESS", "0") == "1",
+            hierarchy=environment.get("FLOORPLAN_HIERARCHY", "0") == "1",
+            lod=environment.get("FLOORPLAN_LOD") or None,
+        )
+
+class WallTable:
+    """
+    Walls, doors and windows stored as columns: float32 x1/y1/x2/y2, the type
+    code and the group id. align_walls sets the group id to the root of the
+    group the element was linked into, elements start in a group of their own.
+    """
+
+    def __init__(self, x1, y1, x2, y2, type, group=None):
+        self.x1 = np.asarray(x1, dtype=np.float32)
+        self.y1 = np.asarray(y1, dtype=np.float32)
+        self.x2 = np.asarray(x2, dtype=np.float32)
+        self.y2 = np.asarray(y2, dtype=np.float32)
+        self.type = np.asarray(type, dtype=np.int8)
+        if group is None:
+            group = np.arange(len(self.x1))
+        self.group = np.asarray(group, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.x1)
+
+    def copy(self):
+        return WallTable(self.x1.copy(), self.y1.copy(), self.x2.copy(), self.y2.copy(), self.type.copy(), self.group.copy())
+
+    def take(self, indices):
+        return WallTable(self.x1[indices], self.y1[indices], self.x2[indices], self.y2[indices], self.type[indices], self.group[indices])
+
+    def type_names(self):
+        return [TYPE_NAMES[code] for code in self.type.tolist()]
+
+    def width(self):
         return self.x2 - self.x1
 
-    def set_width(self, value: float):
-        if self.group is not None:
-            for wall in self.group:
-                wall.x2 = wall.x1 + value
-        else:
-            self.x2 = self.x1 + value
-
-    def get_height(self):
+    def height(self):
         return self.y2 - self.y1
 
-    def set_height(self, value: float):
-        if self.group is not None:
-            for wall in self.group:
-                wall.y2 = wall.y1 + value
-        else:
-            self.y2 = self.y1 + value
-
     def is_horizontal(self):
-        return self.get_width() > self.get_height()
+        return self.width() > self.height()
 
-    def translate(self, x: float, y: float):
-        if self.group is not None:
-            for wall in self.group:
-                wall._translateSelf(x, y)
-        else:
-            self._translateSelf(x, y)
-    
-    def _translateSelf(self, x: float, y: float):
-        self.x1 += x
-        self.x2 += x
-        self.y1 += y
-        self.y2 += y
+    def set_width(self, selection, value):
+        self.x2[selection] = self.x1[selection] + value
+
+    def set_height(self, selection, value):
+        self.y2[selection] = self.y1[selection] + value
+
+    def translate(self, selection, x: float, y: float):
+        self.x1[selection] += x
+        self.x2[selection] += x
+        self.y1[selection] += y
+        self.y2[selection] += y
 
     def normalize(self, normalizer: float):
         self.x1 *= normalizer
@@ -67,398 +137,893 @@ class Wall:
         self.y1 *= normalizer
         self.y2 *= normalizer
 
-    def link(self, other: "Wall"):
-        # If both walls are not in a group, create a new group with both of them
-        if self.group is None and other.group is None:
-            self.group = other.group = {self, other}
-            return
-
-        # If both walls are grouped, merge the group
-        if self.group is not None and other.group is not None:
-
-            new_list = {*self.group, *other.group}
-            for wall in self.group:
-                wall.group = new_list
-
-            for wall in other.group:
-                wall.group = new_list
-        
-        # If other is in a group add self to it
-        if other.group is not None:
-            self.group = other.group
-            other.group.add(self)
-            return
-
-        # If self is in a group add other to it
-        if self.group is not None:
-            other.group = self.group
-            self.group.add(other)
-            return
-        
-        # Unreachable
-        assert False
-    
-    def get_point(self, direction: int):
-        if direction == 0:
-            return np.array(((self.x1 + self.x2) / 2, self.y1), dtype=np.float)
-
-        if direction == 1:
-            return np.array((self.x2, (self.y1 + self.y2) / 2), dtype=np.float)
-
-        if direction == 2:
-            return np.array(((self.x1 + self.x2) / 2, self.y2), dtype=np.float)
-
-        if direction == 3:
-            return np.array((self.x1, (self.y1 + self.y2) / 2), dtype=np.float)
-        
-        # Illegal direction
-        assert False
-        
+    def socket_points(self, direction: int):
+        """Middle of the given side of every element as a float64 [N, 2] array"""
+        x1, y1 = self.x1.astype(np.float64), self.y1.astype(np.float64)
+        x2, y2 = self.x2.astype(np.float64), self.y2.astype(np.float64)
+        return np.stack(get_point(x1, y1, x2, y2, direction), axis=-1)
 
 @dataclass
-class Socket:
-    wall: Wall
-    direction: int
-    original_position: Any = field(init=False)
-    tolerance: float
-
-    def __post_init__(self):
-        self.original_position = self.wall.get_point(self.direction)
-
-    @property
-    def position(self):
-        return self.wall.get_point(self.direction)
-
-    def get_opposite(self):
-        return (self.direction + 2) % 4
+class Detections:
+    """
+    Elements detected on a plan image: [N, 4] float32 boxes as x1, y1, x2, y2
+    in pixels, their type codes, the detection scores if known, the image size
+    and the average door width in pixels, which sets the scale of the model.
+    Without any door the scale is None and no model can be built.
+    """
+
+    boxes: np.ndarray
+    type: np.ndarray
+    scores: "np.ndarray | None"
+    width: int
+    height: int
+    average_door: "float | None"
+
+    @staticmethod
+    def from_rois(rois: np.ndarray, class_ids: np.ndarray, scores: "np.ndarray | None", width: int, height: int):
+        """Detections from the y1, x1, y2, x2 rois and class ids of the model"""
+        rois = np.asarray(rois).reshape(-1, 4)
+        type = np.asarray(class_ids, dtype=np.int8).reshape(-1)
+        doors = rois[type == DOOR].astype(np.float64)
+        average_door = None
+        if len(doors):
+            average_door = float(np.maximum(np.abs(doors[:, 2] - doors[:, 0]), np.abs(doors[:, 3] - doors[:, 1])).mean())
+
+        return Detections(rois[:, [1, 0, 3, 2]].astype(np.float32), type, scores, width, height, average_door)
+
+    @staticmethod
+    def from_json(data: dict):
+        """Detections from their JSON form, see `to_json`"""
+        boxes = np.array(
+            [(point["x1"], point["y1"], point["x2"], point["y2"]) for point in data["points"]],
+            dtype=np.float32,
+        ).reshape(-1, 4)
+        type = np.array([TYPE_CODES[entry["name"]] for entry in data["classes"]], dtype=np.int8)
+        scores = np.array(data["scores"], dtype=np.float32) if "scores" in data else None
+        return Detections(boxes, type, scores, data["Width"], data["Height"], data.get("averageDoor"))
+
+    def to_json(self):
+        data = {
+            "points": [
+                {"x1": x1, "y1": y1, "x2": x2, "y2": y2}
+                for x1, y1, x2, y2 in self.boxes.tolist()
+            ],
+            "classes": [{"name": name} for name in (TYPE_NAMES[code] for code in self.type.tolist())],
+            "Width": self.width,
+            "Height": self.height,
+            "averageDoor": self.average_door,
+        }
+        if self.scores is not None:
+            data["scores"] = self.scores.tolist()
+        return data
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def walls(self):
+        return WallTable(*self.boxes.T.copy(), self.type.copy())
+
+def get_point(x1, y1, x2, y2, direction: int):
+    if direction == 0:
+        return ((x1 + x2) / 2, y1)
+
+    if direction == 1:
+        return (x2, (y1 + y2) / 2)
+
+    if direction == 2:
+        return ((x1 + x2) / 2, y2)
+
+    if direction == 3:
+        return (x1, (y1 + y2) / 2)
     
-    def is_horizontal(self):
-        return self.direction == 1 or self.direction == 3
-
-def align_walls(walls: "list[Wall]"):
-    sockets: "dict[int, list[Socket]]" = {
-        0: [],
-        1: [],
-        2: [],
-        3: [],
-    }
-
-    for wall in walls:
-        horizontal = wall.is_horizontal()
-        vertical = not horizontal
+    # Illegal direction
+    assert False
+
+class WallGroups:
+    """
+    Disjoint sets of linked walls with lazy group-wide edits.
+
+    The sets use path compression and union by rank. Every node stores its
+    translation relative to its parent, so translating a group only changes
+    the root. Setting the width or height of a group is recorded on the root
+    with a timestamp and wins over the wall's own size when newer. On union
+    the pending sizes of the smaller group are written to its members, which
+    costs O(n log n) over all unions. Call `apply` to write the results back.
+    """
+
+    def __init__(self, walls: WallTable):
+        count = len(walls)
+        self.walls = walls
+        self.x1 = walls.x1.tolist()
+        self.y1 = walls.y1.tolist()
+        self.parent = list(range(count))
+        self.rank = [0] * count
+        self.members = [[index] for index in range(count)]
+        self.offset_x = [0.0] * count
+        self.offset_y = [0.0] * count
+        self.clock = 0
+
+        # Own size of every wall and when it was set
+        self.width = walls.width().tolist()
+        self.height = walls.height().tolist()
+        self.width_stamp = [0] * count
+        self.height_stamp = [0] * count
+
+        # Size set on the whole group, stored on the root
+        self.group_width: "list[tuple[float, int] | None]" = [None] * count
+        self.group_height: "list[tuple[float, int] | None]" = [None] * count
+    def find(self, index: int):
+        path = []
+        while self.parent[index] != index:
+            path.append(index)
+            index = self.parent[index]
+        root = index
+
+        # Point the whole path to the root, summing the relative offsets on the way
+        offset_x = offset_y = 0.0
+        for node in reversed(path):
+            offset_x += self.offset_x[node]
+            offset_y += self.offset_y[node]
+            self.offset_x[node] = offset_x
+            self.offset_y[node] = offset_y
+            self.parent[node] = root
+
+        return root
+
+    def get_offset(self, index: int):
+        root = self.find(index)
+        if root == index:
+            return self.offset_x[root], self.offset_y[root]
+        return self.offset_x[index] + self.offset_x[root], self.offset_y[index] + self.offset_y[root]
+
+    def get_width(self, index: int):
+        pending = self.group_width[self.find(index)]
+        if pending is not None and pending[1] > self.width_stamp[index]:
+            return pending[0]
+        return self.width[index]
+
+    def get_height(self, index: int):
+        pending = self.group_height[self.find(index)]
+        if pending is not None and pending[1] > self.height_stamp[index]:
+            return pending[0]
+        return self.height[index]
+
+    def get_bounds(self, index: int):
+        offset_x, offset_y = self.get_offset(index)
+        x1 = self.x1[index] + offset_x
+        y1 = self.y1[index] + offset_y
+        return x1, y1, x1 + self.get_width(index), y1 + self.get_height(index)
+
+    def get_point(self, index: int, direction: int):
+        return get_point(*self.get_bounds(index), direction)
+
+    def translate(self, index: int, x: float, y: float):
+        root = self.find(index)
+        self.offset_x[root] += x
+        self.offset_y[root] += y
+
+    def set_width(self, index: int, value: float):
+        self.clock += 1
+        self.group_width[self.find(index)] = (value, self.clock)
+
+    def set_height(self, index: int, value: float):
+        self.clock += 1
+        self.group_height[self.find(index)] = (value, self.clock)
+
+    def link(self, a: int, b: int):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
 
-        # If the wall is close enough to a square, consider is horizontal and vertical at once
-        if abs((wall.get_height() - wall.get_width()) / (wall.get_height() + wall.get_width())) < 0.15:
-            horizontal = True
-            vertical = True
+        small, large = (root_a, root_b) if len(self.members[root_a]) < len(self.members[root_b]) else (root_b, root_a)
+
+        # Resolve the sizes of the smaller group, the pending sizes of the larger one stay on the new root
+        self.clock += 1
+        for index in self.members[small]:
+            self.width[index] = self.get_width(index)
+            self.height[index] = self.get_height(index)
+            self.width_stamp[index] = self.clock
+            self.height_stamp[index] = self.clock
+
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        if self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+
+        # Attach root_b under root_a, its offset becomes relative to root_a
+        self.parent[root_b] = root_a
+        self.offset_x[root_b] -= self.offset_x[root_a]
+        self.offset_y[root_b] -= self.offset_y[root_a]
+
+        self.group_width[root_a] = self.group_width[large]
+        self.group_height[root_a] = self.group_height[large]
+        self.group_width[root_b] = self.group_height[root_b] = None
+
+        members = self.members[large]
+        members.extend(self.members[small])
+        self.members[small] = self.members[large] = []
+        self.members[root_a] = members
+
+    def apply(self):
+        count = len(self.parent)
+        bounds = np.array([self.get_bounds(index) for index in range(count)], dtype=np.float64).reshape(-1, 4)
+        self.walls.x1[:], self.walls.y1[:], self.walls.x2[:], self.walls.y2[:] = bounds.T
+        self.walls.group[:] = [self.find(index) for index in range(count)]
+
+class SocketGrid:
+    """
+    Uniform grid hash of socket positions. Lookups visit the sockets in the
+    cells covering the search radius in insertion order, so the first match is
+    the same as when scanning the whole list.
+    """
+
+    def __init__(self, positions: np.ndarray, tolerances: np.ndarray):
+        self.alive = [True] * len(positions)
+        self.cells: "dict[tuple[int, int], list[int]]" = {}
+
+        tolerances = np.sort(tolerances[tolerances > 0])
+        self.cell_size = float(tolerances[len(tolerances) // 2]) if len(tolerances) else 1.0
+
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        for index, cell in enumerate(map(tuple, cells.tolist())):
+            self.cells.setdefault(cell, []).append(index)
+
+    def _cell(self, x: float, y: float):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def take_first(self, position: "tuple[float, float]", radius: float, predicate: "Callable[[int], bool]"):
+        x, y = position
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            buckets = self.cells.values()
+        else:
+            buckets = [self.cells.get((cell_x, cell_y), ()) for cell_x in range(min_x, max_x + 1) for cell_y in range(min_y, max_y + 1)]
+
+        candidates = sorted(index for bucket in buckets for index in bucket if self.alive[index])
+        for index in candidates:
+            if predicate(index):
+                self.alive[index] = False
+                return index
+
+        return None
+
+def align_walls(walls: WallTable):
+    groups = WallGroups(walls)
+    width, height = walls.width(), walls.height()
+    horizontal = width > height
+
+    # If the wall is close enough to a square, consider is horizontal and vertical at once
+    with np.errstate(divide="ignore", invalid="ignore"):
+        square = np.abs((height - width) / (height + width)) < 0.15
+
+    # Sockets of each direction in wall order: wall indices, positions and tolerances
+    sockets: "dict[int, tuple[list[int], list[tuple[float, float]], list[float]]]" = {}
+    for direction in [0, 1, 2, 3]:
+        if direction == 1 or direction == 3:
+            selected = np.flatnonzero(horizontal | square)
+            tolerance = height[selected]
+        else:
+            selected = np.flatnonzero(~horizontal | square)
+            tolerance = width[selected]
 
-        if horizontal:
-            tolerance = wall.get_height()
-            sockets[1].append(Socket(wall, 1, tolerance))
-            sockets[3].append(Socket(wall, 3, tolerance))
+        positions = walls.socket_points(direction)[selected]
+        sockets[direction] = (selected.tolist(), positions, tolerance.astype(np.float64))
 
-        if vertical:
-            tolerance = wall.get_width()
-            sockets[0].append(Socket(wall, 0, tolerance))
-            sockets[2].append(Socket(wall, 2, tolerance))
-    
     for direction in [0, 1]:
-        direction_sockets = sockets[direction]
-        j = 0
+        indices, positions, tolerances = sockets[direction]
+        opposite_direction = (direction + 2) % 4
+        opposite_indices, opposite_positions, opposite_tolerances = sockets[opposite_direction]
+
+        opposite_grid = SocketGrid(opposite_positions, opposite_tolerances)
+        opposite_positions = list(map(tuple, opposite_positions.tolist()))
+        opposite_tolerances = opposite_tolerances.tolist()
+        is_horizontal = direction == 1
         matches = 0
 
-        while j < len(direction_sockets):
-            socket = direction_sockets[j]
-            j += 1
-            
-            opposite_sockets = sockets[socket.get_opposite()]
-
-            # Find socket with opposite direction that is close enough
-            for opposite_socket in opposite_sockets:
-                distance = np.linalg.norm(socket.original_position - opposite_socket.original_position)
+        for index, position, tolerance in zip(indices, map(tuple, positions.tolist()), tolerances.tolist()):
+            def is_match(opposite: int):
+                dx = position[0] - opposite_positions[opposite][0]
+                dy = position[1] - opposite_positions[opposite][1]
+                distance = math.sqrt(dx * dx + dy * dy)
 
-                if socket.is_horizontal():
-                    distance += abs(socket.wall.get_height() - opposite_socket.wall.get_height())
+                if is_horizontal:
+                    distance += abs(groups.get_height(index) - groups.get_height(opposite_indices[opposite]))
                 else:
-                    distance += abs(socket.wall.get_width() - opposite_socket.wall.get_width())
+                    distance += abs(groups.get_width(index) - groups.get_width(opposite_indices[opposite]))
 
-                tolerance = min(socket.tolerance, opposite_socket.tolerance)
-                if distance <= tolerance:
-                    break
-            else:
-                opposite_socket = None
-            
-            if opposite_socket is None:
-                continue
-            
-            matches += 1
+                return distance <= min(tolerance, opposite_tolerances[opposite])
 
-            # Remove the matched sockets
-            direction_sockets.remove(socket)
-            opposite_sockets.remove(opposite_socket)
+            # Find the first socket with opposite direction that is close enough, the
+            # distance is at least the euclidean one so only the tolerance radius needs to be searched
+            opposite = opposite_grid.take_first(position, tolerance, is_match)
+            if opposite is None:
+                continue
 
-            # Rollback iteration to account for removed element
-            j -= 1
+            opposite_index = opposite_indices[opposite]
+            matches += 1
 
             # Unify the thickness
-            if socket.is_horizontal():
-                value = (socket.wall.get_height() + opposite_socket.wall.get_height()) / 2
-                socket.wall.set_height(value)
-                opposite_socket.wall.set_height(value)
+            if is_horizontal:
+                value = (groups.get_height(index) + groups.get_height(opposite_index)) / 2
+                groups.set_height(index, value)
+                groups.set_height(opposite_index, value)
             else:
-                value = (socket.wall.get_width() + opposite_socket.wall.get_width()) / 2
-                socket.wall.set_width(value)
-                opposite_socket.wall.set_width(value)
+                value = (groups.get_width(index) + groups.get_width(opposite_index)) / 2
+                groups.set_width(index, value)
+                groups.set_width(opposite_index, value)
 
             # Offset for the opposite socket to be aligned with this
-            center = (opposite_socket.position + socket.position) / 2
+            point = groups.get_point(index, direction)
+            opposite_point = groups.get_point(opposite_index, opposite_direction)
+            center_x = (opposite_point[0] + point[0]) / 2
+            center_y = (opposite_point[1] + point[1]) / 2
 
-            correction = (socket.position - center) * -1
-            socket.wall.translate(*correction)
+            groups.translate(index, center_x - point[0], center_y - point[1])
 
-            correction = (opposite_socket.position - center) * -1
-            opposite_socket.wall.translate(*correction)
+            # Read the opposite socket again, it moved as well if the walls are already linked
+            opposite_point = groups.get_point(opposite_index, opposite_direction)
+            groups.translate(opposite_index, center_x - opposite_point[0], center_y - opposite_point[1])
 
             # Join the two walls together
-            opposite_socket.wall.link(socket.wall)
-
-        print(f"For direction {direction} aligned {matches} pairs")
-
-def walls_from_json(data: dict):
-    walls: "list[Wall]" = []
-
-    for i, point in enumerate(data["points"]):
-        walls.append(Wall(
-            point["x1"], # type: ignore
-            point["y1"],
-            point["x2"],
-            point["y2"],
-            data["classes"][i]["name"]
-        ))
-    
-    return walls
-
-def walls_to_json(walls: "list[Wall]"):
-    points = []
-
-    for wall in walls:
-        points.append({
-            "x1": wall.x1,
-            "y1": wall.y1,
-            "x2": wall.x2,
-            "y2": wall.y2,
-        })
+            groups.link(opposite_index, index)
+
+        logger.debug("For direction %d aligned %d pairs", direction, matches)
+
+    groups.apply()
+
+def axis_columns(walls: WallTable, horizontal: np.ndarray):
+    """Start and end of every element along its orientation and across it, as float64"""
+    x1, y1 = walls.x1.astype(np.float64), walls.y1.astype(np.float64)
+    x2, y2 = walls.x2.astype(np.float64), walls.y2.astype(np.float64)
+    return (
+        np.where(horizontal, x1, y1), np.where(horizontal, x2, y2),
+        np.where(horizontal, y1, x1), np.where(horizontal, y2, x2),
+    )
+
+def from_axis_columns(horizontal, along1, along2, across1, across2, type, group):
+    return WallTable(
+        np.where(horizontal, along1, across1), np.where(horizontal, across1, along1),
+        np.where(horizontal, along2, across2), np.where(horizontal, across2, along2),
+        type, group,
+    )
+
+def merge_collinear(walls: WallTable, tolerance: float):
+    """
+    Merges boxes of the same type and orientation that lie on the same line,
+    with equal extent across it, and overlap or touch along it. The boxes are
+    sorted by line and start, a box continues the current run while it starts
+    before the furthest end seen on its line.
+    """
+
+    if len(walls) == 0:
+        return walls
+
+    horizontal = walls.is_horizontal()
+    along1, along2, across1, across2 = axis_columns(walls, horizontal)
+    line1 = np.round(across1 / tolerance).astype(np.int64)
+    line2 = np.round(across2 / tolerance).astype(np.int64)
+
+    order = np.lexsort((along1, line2, line1, horizontal, walls.type))
+    horizontal, type, group = horizontal[order], walls.type[order], walls.group[order]
+    along1, along2, across1, across2 = along1[order], along2[order], across1[order], across2[order]
+    line1, line2 = line1[order], line2[order]
+
+    new_line = np.ones(len(order), dtype=bool)
+    new_line[1:] = (type[1:] != type[:-1]) | (horizontal[1:] != horizontal[:-1]) \
+        | (line1[1:] != line1[:-1]) | (line2[1:] != line2[:-1])
+
+    # Running maximum of the ends restarted on every line, lines are moved apart by more than their extent
+    span = along2.max() - along1.min() + 2 * tolerance + 1
+    offset = (np.cumsum(new_line) - 1) * span
+    furthest = np.maximum.accumulate(along2 + offset) - offset
+
+    new_run = new_line.copy()
+    new_run[1:] |= along1[1:] > furthest[:-1] + tolerance
+    starts = np.flatnonzero(new_run)
+
+    return from_axis_columns(
+        horizontal[starts], along1[starts], np.maximum.reduceat(along2, starts),
+        across1[starts], across2[starts], type[starts], group[starts],
+    )
+
+def trim_openings(walls: WallTable, tolerance: float):
+    """
+    Cuts the parts of walls covered by a door or window of the same
+    orientation, splitting walls with an opening in the middle and dropping
+    walls covered completely. Openings are swept in order of their start, so
+    only the openings starting within the longest opening before a wall are
+    tested. Returns the walls with the number of trimmed, split and removed ones.
+    """
+
+    horizontal = walls.is_horizontal()
+    along1, along2, across1, across2 = (column.tolist() for column in axis_columns(walls, horizontal))
+    horizontal = horizontal.tolist()
+    is_wall = (walls.type == WALL).tolist()
+
+    # Openings of each orientation sorted by their start
+    openings: "dict[bool, tuple[list[float], list[int], float]]" = {}
+    for orientation in (False, True):
+        indices = sorted((index for index in range(len(walls)) if not is_wall[index] and horizontal[index] == orientation), key=lambda index: along1[index])
+        longest = max([along2[index] - along1[index] for index in indices] + [0.0])
+        openings[orientation] = ([along1[index] for index in indices], indices, longest)
+
+    rows: "list[int]" = []
+    pieces: "list[tuple[float, float]]" = []
+    trimmed = split = removed = 0
+
+    for index in range(len(walls)):
+        start, end = along1[index], along2[index]
+        if not is_wall[index]:
+            rows.append(index)
+            pieces.append((start, end))
+            continue
+
+        starts, indices, longest = openings[horizontal[index]]
+        first = bisect_left(starts, start - longest)
+        last = bisect_left(starts, end)
+        cuts = sorted(
+            (along1[opening], along2[opening]) for opening in indices[first:last]
+            if along2[opening] > start and across1[opening] < across2[index] and across2[opening] > across1[index]
+        )
+
+        remaining = []
+        position = start
+        for cut_start, cut_end in cuts:
+            if cut_start - position > tolerance:
+                remaining.append((position, cut_start))
+            position = max(position, cut_end)
+        if end - position > tolerance:
+            remaining.append((position, end))
+
+        if remaining != [(start, end)]:
+            trimmed += 1
+            split += len(remaining) > 1
+            removed += not remaining
+
+        rows.extend([index] * len(remaining))
+        pieces.extend(remaining)
+
+    table = walls.take(np.array(rows, dtype=np.int64))
+    along = np.array(pieces, dtype=np.float64).reshape(-1, 2)
+    horizontal = table.is_horizontal()
+    _, _, across1, across2 = axis_columns(table, horizontal)
+    table = from_axis_columns(horizontal, along[:, 0], along[:, 1], across1, across2, table.type, table.group)
+
+    return table, trimmed, split, removed
+
+def merge_walls(walls: WallTable, tolerance: float):
+    """Merges collinear boxes and trims walls at openings, returns the new walls and statistics"""
+    merged = merge_collinear(walls, tolerance)
+    table, trimmed, split, removed = trim_openings(merged, tolerance)
+
+    return table, {
+        "boxes_before": len(walls),
+        "merged": len(walls) - len(merged),
+        "trimmed": trimmed,
+        "split": split,
+        "removed": removed,
+        "boxes_after": len(table),
+    }
 
-    return points
+def floor_quads(rectangles: np.ndarray):
+    """[N, 4, 3] quads at height 0 of [N, 4] x1, y1, x2, y2 rectangles"""
+    x1, y1, x2, y2 = np.asarray(rectangles, dtype=np.float32).reshape(-1, 4).T
+    zero = np.zeros_like(x1)
+    return np.stack([
+        np.stack([x1, y1, zero], axis=-1),
+        np.stack([x1, y2, zero], axis=-1),
+        np.stack([x2, y2, zero], axis=-1),
+        np.stack([x2, y1, zero], axis=-1),
+    ], axis=1)
+
+def add_low_detail(builder: MeshBuilder, walls: WallTable, rooms: "dict[int, list[tuple[float, float, float, float]]]"):
+    """
+    Adds a low detail level of the model: one mesh of full height walls, with
+    openings filled in and merged with the walls on their line, and one mesh
+    of the room bounding rectangles. The mesh extras list the index range of
+    every wall group and room.
+    """
+
+    if len(rooms):
+        bounds = np.array([
+            [min(quad[0] for quad in quads), min(quad[1] for quad in quads), max(quad[2] for quad in quads), max(quad[3] for quad in quads)]
+            for quads in rooms.values()
+        ])
+        builder.add_quads(floor_quads(bounds))
+        builder.create_grouped_mesh("Rooms_low", [f"Room_{name}" for name in rooms.keys()], [1] * len(rooms))
+
+    filled = walls.copy()
+    filled.type[:] = WALL
+    filled = merge_collinear(filled, MERGE_TOLERANCE)
+    if len(filled) == 0:
+        return
+
+    order = np.argsort(filled.group, kind="stable")
+    filled = filled.take(order)
+    zeros = np.zeros(len(filled), dtype=np.float32)
+    boxes = np.stack([filled.x1, filled.y1, zeros, filled.x2, filled.y2, zeros + WALL_HEIGHT], axis=1)
+    quads, inverted, counts = cube_quads(boxes)
+
+    groups, starts = np.unique(filled.group, return_index=True)
+    quad_counts = np.add.reduceat(counts, starts)
+    builder.add_quads(quads, inverted)
+    builder.create_grouped_mesh("Walls_low", [f"Walls_{group}" for group in groups.tolist()], quad_counts.tolist())
+
+def element_boxes(walls: WallTable):
+    """
+    Boxes of the elements as [M, 6] rows of x1, y1, z1, x2, y2, z2, with the
+    element of every box and whether it is the upper part of a window.
+    """
+
+    height = WALL_HEIGHT
+    count = len(walls)
+    x1, y1, x2, y2 = (column.astype(np.float64) for column in (walls.x1, walls.y1, walls.x2, walls.y2))
+    horizontal = walls.is_horizontal()
+    opening = walls.type != WALL
+
+    # Doors and windows are narrowed to at most 0.2 units
+    thickness = np.where(horizontal, y2 - y1, x2 - x1)
+    new_thickness = np.where(thickness < 0.2, 0.8 * thickness, 0.2)
+    center = np.where(horizontal, (y1 + y2) * 0.5, (x1 + x2) * 0.5)
+    narrow_x = opening & ~horizontal
+    narrow_y = opening & horizontal
+    box_x1 = np.where(narrow_x, center - new_thickness * 0.5, x1)
+    box_x2 = np.where(narrow_x, center + new_thickness * 0.5, x2)
+    box_y1 = np.where(narrow_y, center - new_thickness * 0.5, y1)
+    box_y2 = np.where(narrow_y, center + new_thickness * 0.5, y2)
+
+    # Windows are split into a box below and above the glass
+    window = walls.type == WINDOW
+    element = np.repeat(np.arange(count), np.where(window, 2, 1))
+    upper = np.zeros(len(element), dtype=bool)
+    upper[1:] = element[1:] == element[:-1]
+    z1 = np.where(window[element], np.where(upper, height * 2/3, 0), 0)
+    z2 = np.where(window[element] & ~upper, height / 3, height)
+    boxes = np.stack([box_x1[element], box_y1[element], z1, box_x2[element], box_y2[element], z2], axis=1)
+    return boxes, element, upper
+
+def build_geometry(walls: WallTable, rooms: "dict[int, list[tuple[float, float, float, float]]]", options: "GeometryOptions | None" = None):
+    """Meshes the rooms and elements, see `GeometryOptions` for the output modes"""
+    options = options or GeometryOptions()
+    builder = MeshBuilder(packed=options.packed, quantize=options.quantize, compress=options.compress, hierarchy=options.hierarchy)
+
+    if options.lod == "low":
+        add_low_detail(builder, walls, rooms)
+        return builder.build()
+
+    def finish():
+        if options.lod == "msft":
+            builder.begin_lod()
+            add_low_detail(builder, walls, rooms)
+        return builder.build()
+
+    def emit(quads: np.ndarray, inverted: np.ndarray, names: "list[str]", quad_counts: "list[int]", categories: "list[str]"):
+        """Adds consecutive meshes of quads, or one mesh per category when consolidating"""
+        if not options.consolidate:
+            builder.add_quads(quads, inverted)
+            builder.create_meshes(names, quad_counts)
+            return
 
-def build_geometry(walls: "list[Wall]"):
-    pass
+        mesh_category = np.array(categories)
+        quad_category = np.repeat(mesh_category, quad_counts)
+        for category in dict.fromkeys(categories):
+            selected = quad_category == category
+            builder.add_quads(quads[selected], inverted[selected])
+            chosen = np.flatnonzero(mesh_category == category).tolist()
+            builder.create_grouped_mesh(category, [names[index] for index in chosen], [quad_counts[index] for index in chosen])
+
+    room_quads = floor_quads([quad for quads in rooms.values() for quad in quads])
+    emit(room_quads, np.zeros(len(room_quads), dtype=bool), [f"Room_{name}" for name in rooms.keys()], [len(quads) for quads in rooms.values()], ["Rooms"] * len(rooms))
+
+    boxes, element, upper = element_boxes(walls)
+    x1, y1, x2, y2 = (column.astype(np.float64) for column in (walls.x1, walls.y1, walls.x2, walls.y2))
+
+    # Doors and windows get a floor quad
+    floors = np.flatnonzero(walls.type != WALL)
+    type_names = walls.type_names()
+
+    if options.instancing:
+        names = [f"Floor_{index}" for index in floors.tolist()]
+        emit(floor_quads(np.stack([x1, y1, x2, y2], axis=1)[floors]), np.zeros(len(floors), dtype=bool), names, [1] * len(floors), ["Floors"] * len(floors))
+
+        # One unit cube per kind of box, windows have a lower and an upper kind
+        kinds = walls.type[element].astype(np.int64)
+        kinds[upper] = 0
+        for kind, name in ((WALL, "Wall"), (DOOR, "Door"), (WINDOW, "Window_lower"), (0, "Window_upper")):
+            selected = np.flatnonzero(kinds == kind)
+            elements = element[selected].tolist()
+            builder.add_instances(
+                name, boxes[selected],
+                names=[f"{type_names[index].capitalize()}_{index}" for index in elements],
+                extras={"elements": elements},
+                extension=options.instancing == "ext",
+            )
 
-def find_rooms(walls: "list[Wall]", tolerance: float):
-    x_grid: "list[float]" = []
-    y_grid: "list[float]" = []
+        return finish()
 
-    def push_grid_line(grid: "list[float]", position: float):
-        index = bisect_left(grid, position)
-        neighbour_min = grid[index - 1] if 0 <= index - 1 < len(grid) else None
-        if neighbour_min is not None and abs(position - neighbour_min) < tolerance:
-            return
+    faces = visible_faces(boxes) if options.hide_faces else None
+    box_quads, box_inverted, box_counts = cube_quads(boxes, faces)
 
-        neighbour_max = grid[index] if 0 <= index < len(grid) else None
-        if neighbour_max is not None and abs(position - neighbour_max) < tolerance:
-            return
-        
-        grid.insert(index, position)
+    # Meshes in the order Floor_i, Type_i of every element
+    quads = np.concatenate((floor_quads(np.stack([x1, y1, x2, y2], axis=1)[floors]), box_quads))
+    inverted = np.concatenate((np.zeros(len(floors), dtype=bool), box_inverted))
+    keys = np.concatenate((2 * floors, np.repeat(2 * element + 1, box_counts)))
+    order = np.argsort(keys, kind="stable")
 
+    mesh_keys, quad_counts = np.unique(keys, return_counts=True)
+    names = []
+    categories = []
+    for key in mesh_keys.tolist():
+        if key % 2 == 0:
+            names.append(f"Floor_{key // 2}")
+            categories.append("Floors")
+        else:
+            names.append(f"{type_names[key // 2].capitalize()}_{key // 2}")
+            categories.append(f"{type_names[key // 2].capitalize()}s")
+    emit(quads[order], inverted[order], names, quad_counts.tolist(), categories)
+
+    return finish()
+
+def cluster_starts(positions: "list[float]", tolerance: float):
+    """
+    Indices of the sorted `positions` that start a cluster. The smallest
+    position not yet covered starts a cluster that covers every position
+    closer than `tolerance` above it. Clusters are anchored instead of
+    chained through neighbours, so the two sides of a thin wall never merge.
+    """
+
+    starts: "list[int]" = []
+    index = 0
+    while index < len(positions):
+        starts.append(index)
+        index = bisect_left(positions, positions[index] + tolerance, index + 1)
+
+    return starts
+
+def grid_lines(positions: np.ndarray, tolerance: float):
+    """Sorted grid lines of the given wall edges, independent of the wall order"""
+    positions = np.sort(positions.astype(np.float64))
+    return positions[cluster_starts(positions.tolist(), tolerance)]
+
+def snap_coordinates(values: np.ndarray, tolerance: float):
+    """Replaces every value with the mean of its cluster, returns the values and the cluster count"""
+    order = np.argsort(values, kind="stable")
+    ordered = values[order].astype(np.float64)
+    starts = cluster_starts(ordered.tolist(), tolerance)
+
+    cluster = np.zeros(len(ordered), dtype=np.int64)
+    cluster[starts[1:]] = 1
+    cluster = np.cumsum(cluster)
+    means = np.bincount(cluster, weights=ordered) / np.bincount(cluster)
+
+    snapped = np.empty(len(values))
+    snapped[order] = means[cluster]
+    return snapped, len(starts)
+
+def snap_walls(walls: WallTable, tolerance: float, grid_tolerance: float):
+    """
+    Snaps nearly equal edges of all walls to shared coordinates, per axis.
+    Walls that would collapse keep their original coordinates on that axis.
+    Returns the number of distinct coordinates and of `find_rooms` grid lines
+    (at `grid_tolerance`) before and after snapping.
+    """
+
+    report = {}
+    for axis, (low, high) in (("x", (walls.x1, walls.x2)), ("y", (walls.y1, walls.y2))):
+        count = len(low)
+        values = np.concatenate((low, high))
+        report[f"{axis}_lines_before"] = len(grid_lines(values, grid_tolerance))
+
+        snapped, clusters = snap_coordinates(values, tolerance)
+        kept = snapped[count:] > snapped[:count]
+        low[kept] = snapped[:count][kept]
+        high[kept] = snapped[count:][kept]
+
+        report[f"{axis}_values_before"] = len(np.unique(values))
+        report[f"{axis}_values_after"] = len(np.unique(np.concatenate((low, high))))
+        report[f"{axis}_lines_after"] = len(grid_lines(np.concatenate((low, high)), grid_tolerance))
+        report[f"{axis}_collapsed"] = int(count - kept.sum())
+
+    return report
+
+def rasterize_walls(walls: WallTable, x_grid: np.ndarray, y_grid: np.ndarray):
+    """
+    Boolean [rows, columns] occupancy of the grid cells whose center lies inside
+    a wall. The covered cell ranges of every wall are found by binary search
+    on the cell centers and summed up in a 2D difference array.
+    """
 
-    for wall in walls:
-        push_grid_line(x_grid, wall.x1)
-        push_grid_line(x_grid, wall.x2)
-        push_grid_line(y_grid, wall.y1)
-        push_grid_line(y_grid, wall.y2)
-    
     width = len(x_grid) - 1
     height = len(y_grid) - 1
-    tiles: "list[int]" = [-1] * (width * height)
-
-    for y, (y1, y2) in enumerate(zip(y_grid, y_grid[1:])):
-        for x, (x1, x2) in enumerate(zip(x_grid, x_grid[1:])):
-            center_x = (x1 + x2) * 0.5
-            center_y = (y1 + y2) * 0.5
-
-            for wall in walls:
-                if wall.x1 < center_x < wall.x2 \
-                    and wall.y1 < center_y < wall.y2:
-                    tiles[x + y * width] = 0
-                    break
-    
-    room_id = 1
-    directions = [(0, 1), (0, -1), (1, 0), (-1, 0)]
-
-    for y in range(height):
-        for x in range(width):
-            index = x + y * width
-
-            # Start floodfill if an unvisited free cell is found
-            if tiles[index] == -1:
-                stack = [(x, y)]
-                tiles[index] = room_id
-
-                while stack:
-                    cx, cy = stack.pop()
-
-                    for dx, dy in directions:
-                        nx, ny = cx + dx, cy + dy
-
-                        # Check bounds
-                        if 0 <= nx < width and 0 <= ny < height:
-                            n_index = nx + ny * width
-
-                            # Check if the neighbor is a free cell (-1)
-                            if tiles[n_index] == -1:
-                                tiles[n_index] = room_id
-                                stack.append((nx, ny))
+    center_x = (x_grid[:-1] + x_grid[1:]) * 0.5
+    center_y = (y_grid[:-1] + y_grid[1:]) * 0.5
+
+    # Cells with wall_x1 < center < wall_x2, same on the y axis
+    x_start = np.searchsorted(center_x, walls.x1.astype(np.float64), side="right")
+    x_end = np.searchsorted(center_x, walls.x2.astype(np.float64), side="left")
+    y_start = np.searchsorted(center_y, walls.y1.astype(np.float64), side="right")
+    y_end = np.searchsorted(center_y, walls.y2.astype(np.float64), side="left")
+
+    covering = (x_start < x_end) & (y_start < y_end)
+    x_start, x_end = x_start[covering], x_end[covering]
+    y_start, y_end = y_start[covering], y_end[covering]
+
+    coverage = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.add.at(coverage, (y_start, x_start), 1)
+    np.add.at(coverage, (y_start, x_end), -1)
+    np.add.at(coverage, (y_end, x_start), -1)
+    np.add.at(coverage, (y_end, x_end), 1)
+    coverage = coverage.cumsum(axis=0).cumsum(axis=1)
+
+    return coverage[:height, :width] > 0
+
+def label_rooms(free: np.ndarray):
+    """
+    Labels the 4-connected components of the free cells with 1, 2, ... in the
+    order their first cell appears in a row-major scan, other cells get 0.
+
+    Every cell points to a parent with a smaller index, the roots of adjacent
+    cells are hooked to the smaller one and the pointers are then jumped
+    until every cell points to its root, the first cell of its component.
+    """
+
+    height, width = free.shape
+    flat = free.ravel()
+    parent = np.arange(flat.size)
+
+    cells = np.arange(flat.size).reshape(height, width)
+    right = free[:, :-1] & free[:, 1:]
+    down = free[:-1, :] & free[1:, :]
+    first = np.concatenate((cells[:, :-1][right], cells[:-1, :][down]))
+    second = np.concatenate((cells[:, 1:][right], cells[1:, :][down]))
+
+    while len(first):
+        first_root = parent[first]
+        second_root = parent[second]
+        linked = first_root != second_root
+        if not linked.any():
+            break
+
+        first, second = first[linked], second[linked]
+        first_root, second_root = first_root[linked], second_root[linked]
+        np.minimum.at(parent, np.maximum(first_root, second_root), np.minimum(first_root, second_root))
+
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+
+    labels = np.zeros(flat.size, dtype=np.int32)
+    _, ids = np.unique(parent[flat], return_inverse=True)
+    labels[flat] = ids + 1
+    return labels.reshape(height, width)
+
+def merge_row_runs(labels: np.ndarray):
+    """
+    Rectangles covering the labeled cells: runs of equal labels in each row,
+    with runs spanning the same columns in consecutive rows stacked together.
+    Returns the label, x1, y1, x2 and y2 columns, the ends are exclusive.
+    """
+
+    height, width = labels.shape
+    change = np.ones((height, width), dtype=bool)
+    change[:, 1:] = labels[:, 1:] != labels[:, :-1]
+    rows, starts = np.nonzero(change)
+
+    # Runs end where the next one of the same row starts
+    ends = np.full(len(starts), width)
+    same_row = rows[1:] == rows[:-1]
+    ends[:-1][same_row] = starts[1:][same_row]
+
+    run_labels = labels[rows, starts]
+    kept = run_labels != 0
+    rows, starts, ends, run_labels = rows[kept], starts[kept], ends[kept], run_labels[kept]
+
+    order = np.lexsort((rows, ends, starts, run_labels))
+    rows, starts, ends, run_labels = rows[order], starts[order], ends[order], run_labels[order]
+
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (run_labels[1:] != run_labels[:-1]) | (starts[1:] != starts[:-1]) \
+        | (ends[1:] != ends[:-1]) | (rows[1:] != rows[:-1] + 1)
+    first = np.flatnonzero(first)
+    last = np.append(first[1:] - 1, len(rows) - 1)
+
+    return run_labels[first], starts[first], rows[first], ends[first], rows[last] + 1
+
+def room_rectangles(labels: np.ndarray):
+    """
+    Decomposes every labeled room into rectangles of grid cells. Rooms are
+    merged both by rows and by columns and keep whichever needs fewer
+    rectangles. Returns the label, x1, y1, x2 and y2 columns ordered by
+    label, the ends are exclusive.
+    """
+
+    by_rows = merge_row_runs(labels)
+    room_id, y1, x1, y2, x2 = merge_row_runs(labels.T)
+    by_columns = (room_id, x1, y1, x2, y2)
+
+    size = int(labels.max()) + 1
+    use_columns = np.bincount(by_columns[0], minlength=size) < np.bincount(by_rows[0], minlength=size)
+
+    chosen = [
+        np.concatenate((row_column[~use_columns[by_rows[0]]], column_column[use_columns[by_columns[0]]]))
+        for row_column, column_column in zip(by_rows, by_columns)
+    ]
+    order = np.lexsort((chosen[1], chosen[2], chosen[0]))
+    return [column[order] for column in chosen]
+
+def find_rooms(walls: WallTable, tolerance: float):
+    x_grid = grid_lines(np.concatenate((walls.x1, walls.x2)), tolerance)
+    y_grid = grid_lines(np.concatenate((walls.y1, walls.y2)), tolerance)
 
-                room_id += 1
-
-    occupied = [0] * len(tiles)
+    width = len(x_grid) - 1
+    height = len(y_grid) - 1
+    if width <= 0 or height <= 0:
+        return {}
+
+    # 0 for cells covered by a wall, otherwise the id of the room
+    labels = label_rooms(~rasterize_walls(walls, x_grid, y_grid))
+    room_count = int(labels.max())
+
+    # Rooms touching the border of the grid are outside of the plan
+    border = np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1]))
+    inside = np.ones(room_count + 1, dtype=bool)
+    inside[border] = False
+    labels = np.where(inside[labels], labels, 0)
+    if not labels.any():
+        return {}
+
+    x_grid, y_grid = x_grid.tolist(), y_grid.tolist()
     room_meshes: "dict[int, list[tuple[float, float, float, float]]]" = {}
-    for y in range(height):
-        for x in range(width):
-            room_id = tiles[x + y * width]
-            if room_id == 0 or occupied[x + y * width] != 0:
-                continue
-
-            iy = y + 1
-            for iy in range(iy, height):
-                if tiles[x + iy * width] != room_id or occupied[x + iy * width] != 0:
-                    break
+    for room_id, x1, y1, x2, y2 in zip(*(column.tolist() for column in room_rectangles(labels))):
+        room_meshes.setdefault(room_id, []).append((x_grid[x1], y_grid[y1], x_grid[x2], y_grid[y2]))
 
-            if iy == width:
-                iy -= 1
-
-            if y == iy:
-                continue
-            
-            ix = x + 1
-            for ix in range(ix, width):
-                failed = False
-
-                for jy in range(y, iy):
-                    if tiles[ix + jy * width] != room_id or occupied[ix + jy * width] != 0:
-                        failed = True
-
-                if failed:
-                    break
-                
-            if ix == width:
-                ix -= 1
-            
-            if x == ix:
-                continue
-            
-            for jy in range(y, iy):
-                for jx in range(x, ix):
-                    occupied[jx + jy * width] = room_id
-            
-            room_meshes.setdefault(room_id, []).append((
-                x_grid[x],
-                y_grid[y],
-                x_grid[ix],
-                y_grid[iy],
-            ))
-    
-    for x in range(width):
-        room_id = tiles[x]
-        if room_id != 0 and room_id in room_meshes:
-            del room_meshes[room_id]
-
-        room_id = tiles[x + (width * (height - 1))]
-        if room_id != 0 and room_id in room_meshes:
-            del room_meshes[room_id]
-
-    for y in range(height):
-        room_id = tiles[y * width]
-        if room_id != 0 and room_id in room_meshes:
-            del room_meshes[room_id]
-
-        room_id = tiles[y * width + width - 1]
-        if room_id != 0 and room_id in room_meshes:
-            del room_meshes[room_id]
-            
-    print(f"Room grid: {width} x {height}, Room Count: {room_id - 1}")
+    logger.debug("Room grid: %d x %d, Room Count: %d", width, height, room_count)
     return room_meshes
 
-def build_3d_model(data: dict):
-    walls = walls_from_json(data)
-    align_walls(walls)
-    data["points"] = walls_to_json(walls)
+def analyze_plan(detections: Detections):
+    """Snaps, aligns and merges the detected elements and finds the rooms, returns the walls in model units and the rooms"""
+    if detections.average_door is None:
+        raise ValueError("No door detected, the scale of the plan is unknown")
 
-    normalizer = 1 / (data["averageDoor"] / 0.8)
-    for wall in walls:
-        wall.normalize(normalizer)
+    walls = detections.walls()
+    for code, count in zip(*np.unique(walls.type, return_counts=True)):
+        metrics.count(metrics.ELEMENTS, int(count), label_value=TYPE_NAMES[int(code)])
 
+    # Tolerances in plan pixels, the model is later scaled for doors to be 0.8 units wide
+    pixels_per_unit = detections.average_door / 0.8
+    with metrics.stage("snap_walls"):
+        snapping = snap_walls(walls, tolerance=SNAP_TOLERANCE * detections.average_door, grid_tolerance=ROOM_TOLERANCE * pixels_per_unit)
+    metrics.annotate("snapping", snapping)
+    logger.debug("Snapped grid lines: x %(x_lines_before)d -> %(x_lines_after)d, y %(y_lines_before)d -> %(y_lines_after)d", snapping)
 
-    builder = MeshBuilder()
-    rooms = find_rooms(walls, tolerance=0.05)
-    for name in rooms.keys():
-        quads = rooms[name]
+    with metrics.stage("align_walls"):
+        align_walls(walls)
 
-        for (x1, y1, x2, y2) in quads:
-            builder.add_quad(
-                [x1, y1, 0],
-                [x1, y2, 0],
-                [x2, y2, 0],
-                [x2, y1, 0],
-            )
-
-        builder.create_mesh(f"Room_{name}")
-
-    height = 2.6
+    walls.normalize(1 / pixels_per_unit)
 
-    for index, wall in enumerate(walls):
-        x1 = wall.x1
-        y1 = wall.y1
-        x2 = wall.x2
-        y2 = wall.y2
+    with metrics.stage("merge_walls"):
+        walls, merging = merge_walls(walls, tolerance=MERGE_TOLERANCE)
+    metrics.annotate("merging", merging)
+    logger.debug("Merged walls: %(boxes_before)d -> %(boxes_after)d boxes, %(merged)d merged, %(trimmed)d trimmed at openings", merging)
 
-        if wall.type == "door" or wall.type == "window":
-            thickness = wall.get_height() if wall.is_horizontal() else wall.get_width()
-            new_thickness = 0.2
-            if new_thickness > thickness:
-                new_thickness = 0.8 * thickness
-
-            builder.add_quad(
-                [x1, y1, 0],
-                [x1, y2, 0],
-                [x2, y2, 0],
-                [x2, y1, 0],
-            )
-            builder.create_mesh(f"Floor_{index}")
+    with metrics.stage("find_rooms"):
+        rooms = find_rooms(walls, tolerance=ROOM_TOLERANCE)
+    metrics.count(metrics.ROOMS, len(rooms), name="rooms")
+    return walls, rooms
 
-            if wall.is_horizontal():
-                center = (y1 + y2) * 0.5
-                y1 = center - new_thickness * 0.5
-                y2 = center + new_thickness * 0.5
-            else:
-                center = (x1 + x2) * 0.5
-                x1 = center - new_thickness * 0.5
-                x2 = center + new_thickness * 0.5
-
-        if wall.type == "window":
-            builder.add_cube(x1, y1, x2, y2, 0, height / 3)
-            builder.add_cube(x1, y1, x2, y2, height * 2/3, height)
-        else:
-            builder.add_cube(x1, y1, x2, y2, 0, height)
-        builder.create_mesh(f"{wall.type.capitalize()}_{index}")
-    
-    return builder.build()
+def build_3d_model(detections: Detections, options: "GeometryOptions | None" = None):
+    walls, rooms = analyze_plan(detections)
+    with metrics.stage("mesh_build"):
+        return build_geometry(walls, rooms, options)
 
 if __name__ == "__main__":
     with open(argv[1], 'rt') as file:
         content = file.read()
 
-    data: dict = loads(content)
-    gltf = build_3d_model(data)
+    gltf = build_3d_model(Detections.from_json(loads(content)))
     gltf.export(argv[1] + ".new.glb")
 
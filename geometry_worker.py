@@ -0,0 +1,132 @@
+"""
+Geometry worker: builds models from detections without the inference stack.
+
+The geometry modules only need numpy and gltflib, so this worker starts in a
+fraction of a second and a small amount of memory, next to the application
+which loads TensorFlow, Keras, skimage and the Mask R-CNN model. Detections
+come as JSON in the shape of `POST /?format=json` of the application.
+
+Usage:
+  python geometry_worker.py build detections.json [...] [--output model.glb]
+  python geometry_worker.py serve [--host 0.0.0.0] [--port 8082]
+  python geometry_worker.py check-imports [--budget 2.0]
+
+`serve` also needs Flask. `check-imports` imports the worker in a fresh
+interpreter and fails if that takes longer than the budget or loads any of
+the inference modules.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from json import loads
+from dataclasses import replace
+from build_3d_model import Detections, GeometryOptions, build_3d_model
+from glb import GLBStream
+import metrics
+
+# Top level modules of the inference stack, never imported by the geometry
+INFERENCE_MODULES = ("tensorflow", "keras", "skimage", "matplotlib", "mrcnn")
+
+# Seconds a fresh interpreter may take to import this worker
+IMPORT_BUDGET = float(os.environ.get("FLOORPLAN_IMPORT_BUDGET", "2.0"))
+
+logger = logging.getLogger(__name__)
+
+def check_imports():
+    """Imports this worker in a fresh interpreter, returns the seconds it took and the inference modules it loaded"""
+    script = "\n".join((
+        "import sys, time",
+        "start = time.perf_counter()",
+        "import geometry_worker",
+        "print(time.perf_counter() - start)",
+        "print(' '.join(sys.modules))",
+    ))
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    seconds, modules = output.splitlines()[-2:]
+    loaded = {name.split(".")[0] for name in modules.split()}
+    return float(seconds), sorted(loaded.intersection(INFERENCE_MODULES))
+
+def build(paths: "list[str]", output: "str | None", options: GeometryOptions):
+    for path in paths:
+        with open(path, "rt") as file:
+            detections = Detections.from_json(loads(file.read()))
+
+        target = output or os.path.splitext(path)[0] + ".glb"
+        with open(target, "wb") as file:
+            GLBStream(build_3d_model(detections, options)).write(file)
+        logger.info("%s: %d detections -> %s", path, len(detections), target)
+
+def create_service(options: GeometryOptions):
+    """Flask application building the model of the detections posted as JSON, `lod` can be set per request"""
+    from flask import Flask, Response, jsonify, request
+
+    service = Flask(__name__)
+
+    @service.route("/", methods=["POST"])
+    def geometry():
+        try:
+            detections = Detections.from_json(request.get_json(force=True))
+        except (KeyError, TypeError, ValueError) as error:
+            return jsonify({"error": f"invalid detections: {error!r}"}), 400
+        if detections.average_door is None:
+            return jsonify({"error": "no door detected, the scale of the plan is unknown"}), 400
+
+        lod = request.args.get("lod", "")
+        request_options = replace(options, lod=lod) if lod in ("low", "msft") else options
+        with metrics.stage("glb_write"):
+            body = GLBStream(build_3d_model(detections, request_options))
+        metrics.count(metrics.BYTES_OUT, len(body), name="bytes")
+        response = Response(body, mimetype="model/gltf-binary", direct_passthrough=True)
+        response.content_length = len(body)
+        return response
+
+    @service.route("/metrics", methods=["GET"])
+    def metrics_report():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    return service
+
+def main(arguments: "list[str]"):
+    parser = ArgumentParser(description="Builds 3D models from floor plan detections without the inference stack")
+    commands = parser.add_subparsers(dest="command")
+    build_parser = commands.add_parser("build", help="write the GLB of detection JSON files")
+    build_parser.add_argument("paths", nargs="+")
+    build_parser.add_argument("--output", help="GLB path, next to each input by default")
+    serve_parser = commands.add_parser("serve", help="serve POST / with detection JSON")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8082)
+    check_parser = commands.add_parser("check-imports", help="check the import time and that no inference module is imported")
+    check_parser.add_argument("--budget", type=float, default=IMPORT_BUDGET, help="seconds")
+    parsed = parser.parse_args(arguments)
+
+    if parsed.command == "build" and parsed.output and len(parsed.paths) > 1:
+        parser.error("--output takes a single detections file")
+
+    options = GeometryOptions.from_environment(os.environ)
+    if parsed.command == "build":
+        build(parsed.paths, parsed.output, options)
+    elif parsed.command == "serve":
+        create_service(options).run(host=parsed.host, port=parsed.port)
+    elif parsed.command == "check-imports":
+        seconds, loaded = check_imports()
+        print(f"import geometry_worker: {seconds:.3f} s (budget {parsed.budget:.3f} s)")
+        if loaded:
+            print(f"inference modules imported: {', '.join(loaded)}")
+        return 0 if seconds <= parsed.budget and not loaded else 1
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("FLOORPLAN_LOG_LEVEL", "INFO"))
+    sys.exit(main(sys.argv[1:]))
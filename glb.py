@@ -0,0 +1,115 @@
+"""
+GLB output streamed from the geometry arrays.
+
+`GLTF.write_glb` pads and concatenates every buffer resource before writing,
+so with a `BytesIO` in between the model is held in memory several times.
+`GLBStream` lays out the JSON chunk and the binary chunk up front, then yields
+the header, the JSON and slices of the buffer data one after another. Only
+one slice is copied at a time, the total length is known before the first
+byte is sent.
+"""
+
+import json
+import struct
+from typing import Any
+from dataclasses import fields, is_dataclass
+import numpy as np
+from gltflib import GLTF
+from gltflib.gltf_resource import GLB_BINARY_CHUNK_TYPE, GLB_JSON_CHUNK_TYPE
+
+GLB_MAGIC = b"glTF"
+GLB_VERSION = 2
+
+# Bytes copied per yielded slice of buffer data
+STREAM_CHUNK_SIZE = 1 << 16
+
+def _padding(length: int):
+    return -length % 4
+
+def _plain(value: "Any"):
+    """JSON data of a model like `del_none(asdict(value))`, which deep copies every leaf value"""
+    if is_dataclass(value):
+        result = {}
+        for field in fields(value):
+            item = getattr(value, field.name)
+            if item is not None:
+                result[field.name] = _plain(item)
+        return result
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items() if item is not None}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+class GLBStream:
+    """
+    Iterable GLB of `gltf`. Buffers with data are placed one after the other,
+    4 byte aligned, in the binary chunk and their views moved along, buffers
+    without data (like meshopt fallback buffers) are kept. The model itself is
+    not changed.
+    """
+
+    def __init__(self, gltf: GLTF, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        model = _plain(gltf.model)
+
+        # Buffer data in binary chunk order, the offset of every buffer with data in the chunk
+        self.parts: "list[memoryview]" = []
+        offsets: "dict[int, int]" = {}
+        binary_length = 0
+        kept: "list[int]" = []
+        for index, buffer in enumerate(gltf.model.buffers or []):
+            if buffer.uri is None:
+                resource = gltf.get_glb_resource() if index == 0 else None
+            else:
+                resource = gltf.get_resource(buffer.uri)
+
+            if resource is None:
+                kept.append(index)
+                continue
+
+            data = memoryview(np.ascontiguousarray(resource.data).view(np.uint8).reshape(-1))
+            offsets[index] = binary_length
+            self.parts.append(data)
+            binary_length += len(data) + _padding(len(data))
+
+        # The binary chunk becomes buffer 0, followed by the buffers without data
+        buffer_ids = {index: 0 for index in offsets}
+        buffer_ids.update((index, new + bool(offsets)) for new, index in enumerate(kept))
+        if "buffers" in model:
+            model["buffers"] = ([{"byteLength": binary_length}] if offsets else []) + [model["buffers"][index] for index in kept]
+        for view in model.get("bufferViews", []):
+            view["byteOffset"] = view.get("byteOffset", 0) + offsets.get(view["buffer"], 0)
+            view["buffer"] = buffer_ids[view["buffer"]]
+            compression = view.get("extensions", {}).get("EXT_meshopt_compression")
+            if compression is not None:
+                compression["byteOffset"] = compression.get("byteOffset", 0) + offsets.get(compression["buffer"], 0)
+                compression["buffer"] = buffer_ids[compression["buffer"]]
+
+        self.json = json.dumps(model, separators=(",", ":")).encode("utf-8")
+        self.json += b" " * _padding(len(self.json))
+        self.binary_length = binary_length if offsets else None
+
+        self.length = 12 + 8 + len(self.json)
+        if self.binary_length is not None:
+            self.length += 8 + self.binary_length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        header = struct.pack("<4sII", GLB_MAGIC, GLB_VERSION, self.length)
+        yield header + struct.pack("<II", len(self.json), GLB_JSON_CHUNK_TYPE) + self.json
+        if self.binary_length is None:
+            return
+
+        yield struct.pack("<II", self.binary_length, GLB_BINARY_CHUNK_TYPE)
+        for part in self.parts:
+            for start in range(0, len(part), self.chunk_size):
+                yield part[start:start + self.chunk_size].tobytes()
+            if _padding(len(part)):
+                yield bytes(_padding(len(part)))
+
+    def write(self, stream):
+        for chunk in self:
+            stream.write(chunk)
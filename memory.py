@@ -0,0 +1,204 @@
+"""
+Memory accounting and admission control for requests.
+
+With tracking enabled tracemalloc follows every allocation (numpy reports its
+buffers to it as well). Stages then record their allocated and peak bytes, see
+`metrics.stage`, and the tracker keeps the top allocating sites of each
+request class. Requests are classified by the size of the uploaded image.
+
+Peaks are only known for requests measured alone, tracemalloc has a single
+process wide peak. Concurrent requests still count, with their allocations.
+
+The budget caps the estimated memory of requests running at the same time, a
+request is estimated from its pixel count and the peak per pixel seen in its
+class, and waits while others use the budget. A single request larger than
+the whole budget still runs alone.
+"""
+
+import threading
+import time
+import tracemalloc
+import metrics
+
+# Upper pixel count bound of each request class
+REQUEST_CLASSES = (
+    ("small", 1_000_000),
+    ("medium", 4_000_000),
+    ("large", 16_000_000),
+    ("huge", float("inf")),
+)
+
+def request_class(width: int, height: int):
+    pixels = width * height
+    for name, limit in REQUEST_CLASSES:
+        if pixels < limit:
+            return name
+    return REQUEST_CLASSES[-1][0]
+
+class RequestMemory:
+    def __init__(self, tracker: "MemoryTracker", width: int, height: int):
+        self.tracker = tracker
+        self.width = width
+        self.height = height
+        self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start_snapshot = tracker.take_snapshot()
+        self.trace = metrics.current_trace()
+        metrics.begin_memory(self.trace)
+        # Traceback of the allocating site -> largest growth seen at a checkpoint
+        self.sites: "dict[str, int]" = {}
+
+    def checkpoint(self):
+        """Records which sites grew since the request started, call while the stage results are alive"""
+        snapshot = self.tracker.take_snapshot()
+        for stat in snapshot.compare_to(self.start_snapshot, "lineno")[:self.tracker.top]:
+            if stat.size_diff <= 0:
+                continue
+
+            site = str(stat.traceback[0])
+            self.sites[site] = max(self.sites.get(site, 0), stat.size_diff)
+
+class MemoryTracker:
+    def __init__(self, frames: int = 1, top: int = 10):
+        self.frames = frames
+        self.top = top
+        self._lock = threading.Lock()
+        # request class -> {requests, peak, peak_per_pixel, sites}
+        self._classes: "dict[str, dict]" = {}
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    def take_snapshot(self):
+        # Leave out the allocations of tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+
+    def begin(self, width: int, height: int):
+        return RequestMemory(self, width, height)
+
+    def finish(self, request: RequestMemory, stage_memory: "list[tuple[str, int, int | None]]"):
+        request.checkpoint()
+        metrics.end_memory(request.trace)
+        # Stages that overlapped other measured requests have no peak
+        peaks = [peak for _, _, peak in stage_memory if peak is not None]
+        peak = max(peaks) if peaks else None
+        pixels = max(1, request.width * request.height)
+
+        with self._lock:
+            report = self._classes.setdefault(request_class(request.width, request.height), {
+                "requests": 0,
+                "peak": 0,
+                "peak_per_pixel": 0.0,
+                "stages": {},
+                "sites": {},
+            })
+            report["requests"] += 1
+            if peak is not None:
+                report["peak"] = max(report["peak"], peak)
+                report["peak_per_pixel"] = max(report["peak_per_pixel"], peak / pixels)
+
+            for name, allocated, stage_peak in stage_memory:
+                stage = report["stages"].setdefault(name, {"peak": 0, "allocated": 0})
+                if stage_peak is not None:
+                    stage["peak"] = max(stage["peak"], stage_peak)
+                stage["allocated"] = max(stage["allocated"], allocated)
+
+            for site, size in request.sites.items():
+                entry = report["sites"].setdefault(site, {"peak": 0, "total": 0, "requests": 0})
+                entry["peak"] = max(entry["peak"], size)
+                entry["total"] += size
+                entry["requests"] += 1
+
+        return peak
+
+    def peak_per_pixel(self, width: int, height: int):
+        """
+        Largest peak per pixel seen in the class of a width x height image.
+        Inference runs on the molded image of a fixed size, so small images
+        have much larger peaks per pixel than large ones.
+        """
+        with self._lock:
+            report = self._classes.get(request_class(width, height))
+            return report["peak_per_pixel"] if report is not None else 0.0
+
+    def report(self):
+        with self._lock:
+            result = {}
+            for name, report in self._classes.items():
+                sites = sorted(report["sites"].items(), key=lambda item: item[1]["peak"], reverse=True)
+                result[name] = {
+                    "requests": report["requests"],
+                    "peak": report["peak"],
+                    "peak_per_pixel": report["peak_per_pixel"],
+                    "stages": dict(report["stages"]),
+                    "top_sites": [dict(site=site, **entry) for site, entry in sites[:self.top]],
+                }
+            return result
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+class MemoryBudget:
+    def __init__(self, limit: int, bytes_per_pixel: float, timeout: float = 30.0):
+        self.limit = limit
+        self.bytes_per_pixel = bytes_per_pixel
+        self.timeout = timeout
+        self.in_use = 0
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.limit > 0
+
+    def estimate(self, width: int, height: int, learned_bytes_per_pixel: float = 0.0):
+        return int(width * height * max(self.bytes_per_pixel, learned_bytes_per_pixel))
+
+    def acquire(self, size: int):
+        if not self.enabled:
+            return 0
+
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.running > 0 and self.in_use + size > self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise MemoryBudgetExceeded(f"Request needs {size} bytes, {self.limit - self.in_use} of {self.limit} available")
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.in_use += size
+            self.running += 1
+            return size
+
+    def release(self, size: int):
+        if not self.enabled:
+            return
+
+        with self._condition:
+            self.in_use -= size
+            self.running -= 1
+            self._condition.notify_all()
+
+    def report(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "bytes_per_pixel": self.bytes_per_pixel,
+                "in_use": self.in_use,
+                "running": self.running,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+            }
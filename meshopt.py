@@ -0,0 +1,202 @@
+"""
+Encoders for the EXT_meshopt_compression bitstream, with reference decoders.
+
+Vertex data uses the attribute codec (version 0): byte wise deltas to the
+previous vertex, zigzag encoded and packed in groups of 16 with 0, 2, 4 or 8
+bits per value. Index data uses the index sequence codec: zigzag deltas as
+LEB128 varints. The encoder always deltas against the first of the two
+baselines of the format, which is the previous index.
+
+The decoders mirror the format for tests and benchmarks, clients decode with
+the meshoptimizer library.
+"""
+
+import numpy as np
+
+EXTENSION = "EXT_meshopt_compression"
+
+VERTEX_HEADER = 0xA0
+INDEX_HEADER = 0xD1
+
+GROUP_SIZE = 16
+# Payload size of a group excluding escaped bytes, by bits per value
+GROUP_BYTES = {0: 0, 2: 4, 4: 8, 8: 16}
+GROUP_BITS = (0, 2, 4, 8)
+
+def vertex_block_size(stride: int):
+    return min((8192 // stride) & ~(GROUP_SIZE - 1), 256)
+
+def _zigzag8(values: np.ndarray):
+    return ((values << 1) ^ np.where(values & 0x80, 0xFF, 0)).astype(np.uint8)
+
+def _unzigzag8(values: np.ndarray):
+    return ((values >> 1) ^ -(values & 1).astype(np.int16)).astype(np.uint8)
+
+def _pack_bits(values: np.ndarray, bits: int):
+    """Packs [G, 16] values below 2 ** bits into bytes, the first value in the high bits"""
+    per_byte = 8 // bits
+    shifts = (bits * np.arange(per_byte - 1, -1, -1)).astype(np.uint8)
+    return np.bitwise_or.reduce(values.reshape(len(values), -1, per_byte) << shifts, axis=2).astype(np.uint8)
+
+def _encode_groups(values: np.ndarray):
+    """Encodes [G, 16] zigzag bytes, returns the bit modes and [G, 32] payloads with their lengths"""
+    count = len(values)
+    payloads = np.zeros((count, 2 * GROUP_SIZE), dtype=np.uint8)
+    lengths = np.zeros((4, count), dtype=np.int64)
+
+    lengths[0] = np.where(values.any(axis=1), 4 * GROUP_SIZE, 0)
+    lengths[3] = GROUP_SIZE
+    candidates = [None, None, None, values]
+    for mode, bits in ((1, 2), (2, 4)):
+        limit = (1 << bits) - 1
+        escaped = values >= limit
+        # Escaped bytes follow the packed values in their original order
+        order = np.argsort(~escaped, axis=1, kind="stable")
+        candidate = np.zeros((count, 2 * GROUP_SIZE), dtype=np.uint8)
+        candidate[:, :GROUP_BYTES[bits]] = _pack_bits(np.minimum(values, limit), bits)
+        candidate[:, GROUP_BYTES[bits]:GROUP_BYTES[bits] + GROUP_SIZE] = np.take_along_axis(values, order, axis=1)
+        candidates[mode] = candidate
+        lengths[mode] = GROUP_BYTES[bits] + escaped.sum(axis=1)
+
+    modes = np.argmin(lengths, axis=0)
+    for mode in (1, 2, 3):
+        selected = modes == mode
+        payloads[selected, :candidates[mode].shape[1]] = candidates[mode][selected]
+    return modes, payloads, lengths[modes, np.arange(count)]
+
+def encode_vertex_buffer(data: np.ndarray):
+    """Encodes [count, stride] bytes of vertex data, the stride a multiple of 4 up to 256"""
+    data = np.ascontiguousarray(data, dtype=np.uint8)
+    count, stride = data.shape
+    if stride % 4 or stride > 256:
+        raise ValueError(f"Vertex stride must be a multiple of 4 up to 256, got {stride}")
+
+    tail = np.zeros(max(stride, 32), dtype=np.uint8)
+    if count == 0:
+        return bytes([VERTEX_HEADER]) + tail.tobytes()
+    tail[-stride:] = data[0]
+
+    # Every vertex is a delta to the one before it, the first one to itself
+    deltas = _zigzag8(data - np.concatenate([data[:1], data[:-1]]))
+
+    block = vertex_block_size(stride)
+    blocks = (count + block - 1) // block
+    padded = np.zeros((blocks * block, stride), dtype=np.uint8)
+    padded[:count] = deltas
+
+    # Rows of [block, channel, group]: the last block only spans its aligned vertex count
+    groups_per_block = np.full(blocks, block // GROUP_SIZE)
+    groups_per_block[-1] = (count - (blocks - 1) * block + GROUP_SIZE - 1) // GROUP_SIZE
+    channels = padded.reshape(blocks, block // GROUP_SIZE, GROUP_SIZE, stride).transpose(0, 3, 1, 2)
+    present = np.arange(block // GROUP_SIZE) < groups_per_block[:, None, None]
+    groups = channels[np.broadcast_to(present, channels.shape[:3])]
+
+    modes, payloads, lengths = _encode_groups(groups)
+
+    # Each channel of a block starts with the 2 bit modes of its groups, 4 per byte from the low bits
+    channel_groups = np.repeat(groups_per_block, stride)
+    header_sizes = (channel_groups + 3) // 4
+    padded_modes = np.zeros((len(channel_groups), 4 * header_sizes.max()), dtype=np.uint8)
+    padded_modes[np.arange(padded_modes.shape[1]) < channel_groups[:, None]] = modes
+    headers = np.bitwise_or.reduce(padded_modes.reshape(len(channel_groups), -1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8), axis=2).astype(np.uint8)
+
+    # Interleave each channel header with the payloads of its groups
+    rows = np.zeros((len(channel_groups) + len(groups), 2 * GROUP_SIZE), dtype=np.uint8)
+    row_lengths = np.zeros(len(rows), dtype=np.int64)
+    header_rows = np.arange(len(channel_groups)) + np.concatenate([[0], np.cumsum(channel_groups)[:-1]])
+    group_rows = np.setdiff1d(np.arange(len(rows)), header_rows, assume_unique=True)
+    rows[header_rows, :headers.shape[1]] = headers
+    row_lengths[header_rows] = header_sizes
+    rows[group_rows] = payloads
+    row_lengths[group_rows] = lengths
+
+    body = rows[np.arange(rows.shape[1]) < row_lengths[:, None]]
+    return bytes([VERTEX_HEADER]) + body.tobytes() + tail.tobytes()
+
+def _decode_group(data: bytes, position: int, bits: int):
+    if bits == 0:
+        return [0] * GROUP_SIZE, position
+    if bits == 8:
+        return list(data[position:position + GROUP_SIZE]), position + GROUP_SIZE
+
+    limit = (1 << bits) - 1
+    escape = position + GROUP_BYTES[bits]
+    values = []
+    for byte in data[position:position + GROUP_BYTES[bits]]:
+        for shift in range(8 - bits, -1, -bits):
+            value = (byte >> shift) & limit
+            if value == limit:
+                value = data[escape]
+                escape += 1
+            values.append(value)
+    return values, escape
+
+def decode_vertex_buffer(data: bytes, count: int, stride: int):
+    """Decodes `count` vertices of `stride` bytes, returns them as [count, stride] bytes"""
+    if data[0] != VERTEX_HEADER:
+        raise ValueError(f"Unsupported vertex codec header {data[0]:#x}")
+
+    baseline = np.frombuffer(data[len(data) - stride:], dtype=np.uint8)
+    deltas = np.zeros((count, stride), dtype=np.uint8)
+    block = vertex_block_size(stride)
+    position = 1
+    for start in range(0, count, block):
+        vertices = min(block, count - start)
+        groups = (vertices + GROUP_SIZE - 1) // GROUP_SIZE
+        for channel in range(stride):
+            header = data[position:position + (groups + 3) // 4]
+            position += len(header)
+            values = []
+            for group in range(groups):
+                bits = GROUP_BITS[(header[group // 4] >> (group % 4 * 2)) & 3]
+                group_values, position = _decode_group(data, position, bits)
+                values.extend(group_values)
+            deltas[start:start + vertices, channel] = values[:vertices]
+
+    # Deltas chain across blocks, so the bytes are one running sum per channel
+    values = np.cumsum(_unzigzag8(deltas), axis=0, dtype=np.uint64) + baseline
+    return (values & 0xFF).astype(np.uint8)
+
+def encode_index_sequence(indices: np.ndarray):
+    """Encodes uint16 or uint32 indices, all as deltas to the previous index"""
+    indices = np.asarray(indices, dtype=np.int64)
+    deltas = np.diff(indices, prepend=0)
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    # The lowest bit selects the baseline, always the first one here
+    values = (zigzag << 1).astype(np.uint64) & 0xFFFFFFFF
+
+    sizes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        sizes += values >= (1 << shift)
+    positions = np.arange(5)
+    parts = ((values[:, None] >> (7 * positions).astype(np.uint64)) & 0x7F).astype(np.uint8)
+    parts |= np.where(positions < sizes[:, None] - 1, 0x80, 0).astype(np.uint8)
+    body = parts[positions < sizes[:, None]]
+    return bytes([INDEX_HEADER]) + body.tobytes() + bytes(4)
+
+def decode_index_sequence(data: bytes, count: int):
+    """Decodes `count` indices of an index sequence, returns them as uint32"""
+    if data[0] != INDEX_HEADER:
+        raise ValueError(f"Unsupported index codec header {data[0]:#x}")
+
+    body = np.frombuffer(data, dtype=np.uint8, offset=1)
+    ends = np.flatnonzero(body < 0x80)[:count]
+    body = body[:ends[-1] + 1] if count else body[:0]
+    value_ids = np.concatenate([[0], np.cumsum(body < 0x80)[:-1]]) if len(body) else body
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = 7 * (np.arange(len(body)) - starts[value_ids])
+    values = np.zeros(count, dtype=np.uint64)
+    np.add.at(values, value_ids, (body & 0x7F).astype(np.uint64) << shifts.astype(np.uint64))
+
+    baselines = (values & 1).astype(np.int64)
+    values >>= np.uint64(1)
+    deltas = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    if not baselines.any():
+        return (np.cumsum(deltas) & 0xFFFFFFFF).astype(np.uint32)
+
+    last = [0, 0]
+    indices = np.empty(count, dtype=np.uint32)
+    for i, (baseline, delta) in enumerate(zip(baselines.tolist(), deltas.tolist())):
+        last[baseline] = (last[baseline] + delta) & 0xFFFFFFFF
+        indices[i] = last[baseline]
+    return indices
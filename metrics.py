@@ -0,0 +1,280 @@
+"""
+Process wide request metrics, rendered in the Prometheus text format.
+
+Stages are timed with `stage(name)`, which feeds the stage histogram and the
+traces active on the current thread. A trace collects the stage timings and
+counts of a single request, see `begin_request`. While tracemalloc is tracing,
+stages also record the bytes they allocated and their peak memory use. The
+tracemalloc peak is process wide, so a stage only has a peak while its
+request is the only one measured, see `begin_memory`.
+"""
+
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = tuple(float(1 << shift) for shift in range(16, 34, 2))
+
+_registry: "list[Histogram | Counter]" = []
+_local = threading.local()
+
+# Traces of the requests whose memory is measured, and a count of measurements started
+_memory_lock = threading.Lock()
+_measured: "set[RequestTrace]" = set()
+_measured_epoch = 0
+
+def _format_labels(label: "str | None", value: "str | None", extra: str = ""):
+    labels = []
+    if label is not None:
+        labels.append(f'{label}="{value}"')
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+def _format_number(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: "str | None" = None, buckets: "tuple[float, ...]" = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., sum, count]
+        self._series: "dict[str | None, list[float]]" = {}
+        _registry.append(self)
+
+    def observe(self, value: float, label_value: "str | None" = None):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(value) for key, value in self._series.items()}
+
+        for label_value in sorted(series, key=str):
+            values = series[label_value]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                labels = _format_labels(self.label, label_value, f'le="{_format_number(float(bound))}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = _format_labels(self.label, label_value)
+            lines.append(f"{self.name}_sum{labels} {_format_number(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help: str, label: "str | None" = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        self._values: "dict[str | None, float]" = {}
+        _registry.append(self)
+
+    def inc(self, value: float = 1, label_value: "str | None" = None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+
+        for label_value in sorted(values, key=str):
+            lines.append(f"{self.name}{_format_labels(self.label, label_value)} {_format_number(values[label_value])}")
+
+        return lines
+
+STAGE_SECONDS = Histogram("floorplan_stage_seconds", "Time spent in each processing stage", label="stage")
+REQUESTS = Counter("floorplan_requests_total", "Processed requests", label="status")
+ELEMENTS = Counter("floorplan_elements_total", "Detected walls, doors and windows", label="type")
+ROOMS = Counter("floorplan_rooms_total", "Rooms found in the aligned walls")
+TRIANGLES = Counter("floorplan_triangles_total", "Triangles written to the generated models")
+BYTES_OUT = Counter("floorplan_response_bytes_total", "Bytes of generated models sent to clients")
+STAGE_PEAK_BYTES = Histogram("floorplan_stage_peak_bytes", "Peak traced memory above the stage start, only with memory tracking", label="stage", buckets=BYTE_BUCKETS)
+
+# Stages reported together in the Server-Timing header
+SERVER_TIMING_GROUPS = {
+    "decode": ("open", "decode"),
+    "preprocess": ("mold",),
+    "inference": ("predict",),
+    "postprocess": ("unmold",),
+    "geometry": ("snap_walls", "align_walls", "merge_walls", "find_rooms", "mesh_build"),
+    "serialization": ("glb_write",),
+}
+
+class RequestTrace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: "list[tuple[str, float, float]]" = []
+        self.counts: "dict[str, float]" = {}
+        self.details: "dict[str, Any]" = {}
+        # (stage, allocated bytes, peak bytes or None) while memory tracking is enabled
+        self.memory: "list[tuple[str, int, int | None]]" = []
+
+    def record(self, name: str, start: float, elapsed: float):
+        self.stages.append((name, start - self.start, elapsed))
+
+    def record_memory(self, name: str, allocated: int, peak: "int | None"):
+        self.memory.append((name, allocated, peak))
+
+    def count(self, name: str, value: float):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def annotate(self, name: str, value: "Any"):
+        self.details[name] = value
+
+    def stage_totals(self):
+        totals: "dict[str, float]" = {}
+        for name, _, elapsed in self.stages:
+            totals[name] = totals.get(name, 0.0) + elapsed
+        return totals
+
+    def server_timing(self):
+        """Value of the Server-Timing header, durations are in milliseconds"""
+        totals = self.stage_totals()
+        entries = []
+        for group, stages in SERVER_TIMING_GROUPS.items():
+            if any(name in totals for name in stages):
+                duration = sum(totals.get(name, 0.0) for name in stages)
+                entries.append(f"{group};dur={duration * 1000:.2f}")
+
+        detections = sum(self.counts.get(name, 0) for name in ("wall", "window", "door"))
+        entries.append(f'detections;desc="{detections:g}"')
+        entries.append(f'triangles;desc="{self.counts.get("triangles", 0):g}"')
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ", ".join(entries)
+
+    def breakdown(self):
+        """Full stage timeline of the request, in milliseconds"""
+        return {
+            "stages": [
+                {"name": name, "start": round(start * 1000, 3), "duration": round(elapsed * 1000, 3)}
+                for name, start, elapsed in self.stages
+            ],
+            "totals": {name: round(elapsed * 1000, 3) for name, elapsed in self.stage_totals().items()},
+            "counts": dict(self.counts),
+            "details": dict(self.details),
+            "memory": [
+                {"name": name, "allocated": allocated, "peak": peak}
+                for name, allocated, peak in self.memory
+            ],
+        }
+
+def _active_traces() -> "list[RequestTrace]":
+    return getattr(_local, "traces", ())
+
+def current_trace() -> "RequestTrace | None":
+    traces = _active_traces()
+    return traces[0] if traces else None
+
+def begin_request():
+    trace = RequestTrace()
+    _local.traces = [trace]
+    return trace
+
+def end_request():
+    end_memory(*_active_traces())
+    _local.traces = []
+
+def begin_memory(trace: "RequestTrace | None"):
+    """Starts measuring the memory of the request of `trace`, until `end_memory` or `end_request`"""
+    global _measured_epoch
+    if trace is None:
+        return
+    with _memory_lock:
+        _measured.add(trace)
+        _measured_epoch += 1
+
+def end_memory(*traces: RequestTrace):
+    with _memory_lock:
+        _measured.difference_update(traces)
+
+def _exclusive_epoch():
+    """The measurement count while the active traces are the only ones measured, otherwise None"""
+    with _memory_lock:
+        if len(_measured) == 1 and not _measured.isdisjoint(_active_traces()):
+            return _measured_epoch
+        return None
+
+@contextmanager
+def activate(traces: "list[RequestTrace | None]"):
+    """Records into the given traces instead, used for work done on behalf of other requests"""
+    previous = _active_traces()
+    _local.traces = [trace for trace in traces if trace is not None]
+    try:
+        yield
+    finally:
+        _local.traces = previous
+
+def _reset_peak():
+    # Before Python 3.9 the peak can not be reset and stays the process peak
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+@contextmanager
+def stage(name: str):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        # Resetting the peak while another request is measured would wipe its peak
+        epoch = _exclusive_epoch()
+        if epoch is not None:
+            _reset_peak()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        for trace in _active_traces():
+            trace.record(name, start, elapsed)
+
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            allocated, peak = current - start_memory, max(0, peak - start_memory)
+            if epoch is None or _exclusive_epoch() != epoch:
+                peak = None
+            else:
+                STAGE_PEAK_BYTES.observe(peak, name)
+            for trace in _active_traces():
+                trace.record_memory(name, allocated, peak)
+
+def count(counter: Counter, value: float = 1, label_value: "str | None" = None, name: "str | None" = None):
+    """Increments `counter` and the matching count of the active traces"""
+    counter.inc(value, label_value)
+    if name is None:
+        name = label_value or counter.name
+    for trace in _active_traces():
+        trace.count(name, value)
+
+def annotate(name: str, value: "Any"):
+    """Adds a detail to the active traces"""
+    for trace in _active_traces():
+        trace.annotate(name, value)
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,156 @@
+"""
+Sampling profiler for one in N requests.
+
+A sampled request gets a background thread that periodically captures the
+Python stacks of the threads working on it. When the request finishes the
+stacks are written in the collapsed format (`flamegraph.pl`, speedscope) and
+the stage spans, together with the TensorFlow step trace of the predict call
+when available, are written as a Chrome trace (chrome://tracing, Perfetto).
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+_local = threading.local()
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class RequestProfile:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.thread_ids = {threading.get_ident()}
+        self.stacks: "Counter[str]" = Counter()
+        self.step_traces: "list[str]" = []
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in tuple(self.thread_ids):
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(labels))] += 1
+            self.sample_count += 1
+
+    def add_step_trace(self, chrome_trace: str):
+        """Stores a TensorFlow timeline in the chrome trace format"""
+        self.step_traces.append(chrome_trace)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def chrome_trace(self, stages: "list[tuple[str, float, float]]", details: dict):
+        events = [
+            {"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": start * 1e6, "dur": elapsed * 1e6, "cat": "stage"}
+            for name, start, elapsed in stages
+        ]
+        events.append({"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "request stages"}})
+
+        # Step traces get their own process ids so they do not collide with the stages,
+        # and are shifted to start with the matching predict stage
+        predict_starts = [start for name, start, _ in stages if name == "predict"]
+        for index, step_trace in enumerate(self.step_traces):
+            step_events = json.loads(step_trace).get("traceEvents", [])
+            timestamps = [event["ts"] for event in step_events if "ts" in event]
+            shift = 0.0
+            if timestamps and index < len(predict_starts):
+                shift = predict_starts[index] * 1e6 - min(timestamps)
+
+            for event in step_events:
+                event["pid"] = f"predict {index}: {event.get('pid', 0)}"
+                if "ts" in event:
+                    event["ts"] += shift
+                events.append(event)
+
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": details}
+
+class SamplingProfiler:
+    def __init__(self, every: int, folder: str, keep: int = 50, interval: float = 0.005):
+        self.every = every
+        self.folder = folder
+        self.keep = keep
+        self.interval = interval
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def should_sample(self):
+        if self.every <= 0:
+            return False
+
+        with self._lock:
+            self._counter += 1
+            return self._counter % self.every == 0
+
+    def begin(self):
+        profile = RequestProfile(self.interval)
+        _local.profiles = [profile]
+        return profile
+
+    def finish(self, profile: RequestProfile, tag: str, stages: "list[tuple[str, float, float]]", details: dict):
+        _local.profiles = []
+        profile.stop()
+
+        os.makedirs(self.folder, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{tag}"
+        base = os.path.join(self.folder, name)
+
+        with open(base + ".collapsed", "wt") as file:
+            file.write(profile.collapsed())
+
+        with open(base + ".trace.json", "wt") as file:
+            json.dump(profile.chrome_trace(stages, details), file)
+
+        self._rotate()
+        return base
+
+    def _rotate(self):
+        names = sorted(name for name in os.listdir(self.folder) if name.endswith(".collapsed"))
+        for name in names[:max(0, len(names) - self.keep)]:
+            base = os.path.join(self.folder, name[:-len(".collapsed")])
+            for suffix in (".collapsed", ".trace.json"):
+                try:
+                    os.remove(base + suffix)
+                except OSError:
+                    pass
+
+def current() -> "list[RequestProfile]":
+    return getattr(_local, "profiles", ())
+
+@contextmanager
+def activate(profiles: "list[RequestProfile | None]"):
+    """Samples the current thread for the given profiles, used for work done on behalf of other requests"""
+    profiles = [profile for profile in profiles if profile is not None]
+    previous = current()
+    thread_id = threading.get_ident()
+    added = [profile for profile in profiles if thread_id not in profile.thread_ids]
+    for profile in added:
+        profile.thread_ids.add(thread_id)
+
+    _local.profiles = profiles
+    try:
+        yield
+    finally:
+        _local.profiles = previous
+        for profile in added:
+            profile.thread_ids.discard(thread_id)
@@ -0,0 +1,326 @@
+"""
+Geometry sessions for interactive editing.
+
+A session keeps the merged wall table in model units, the rooms and the quads
+of every node of a plan analyzed once. Edits move, resize, add or delete
+elements by their id, which is the index in the node names (`Wall_12`), and
+only remesh what they touch:
+
+- the edited elements and the elements touching them, whose hidden faces
+  change, against the elements touching those
+- the rooms touching the edited elements, found again on the grid of the
+  walls around them
+
+Edited coordinates are taken as they are, in plan axes (x, y) and model
+units, they are not snapped or aligned again, nor merged with other boxes.
+Sessions build one mesh per node, the instancing, consolidation and level of
+detail options are not applied.
+"""
+
+import math
+import threading
+import uuid
+from collections import OrderedDict
+import numpy as np
+from MeshBuilder import MeshBuilder, cube_quads, grid_cell_size, grid_cells, visible_faces
+from build_3d_model import (ROOM_TOLERANCE, TYPE_CODES, WALL, Detections, GeometryOptions, WallTable, analyze_plan,
+                            element_boxes, find_rooms, floor_quads)
+
+EDIT_OPERATIONS = ("move", "resize", "add", "delete")
+
+def _is_number(value):
+    """Finite int or float, JSON booleans are ints in Python and are not numbers here"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _overlapping(x1: np.ndarray, y1: np.ndarray, x2: np.ndarray, y2: np.ndarray, box: "tuple[float, float, float, float]", margin: float):
+    return (x1 <= box[2] + margin) & (x2 >= box[0] - margin) & (y1 <= box[3] + margin) & (y2 >= box[1] - margin)
+
+class GeometrySession:
+    def __init__(self, walls: WallTable, rooms: "dict[int, list[tuple[float, float, float, float]]]", options: "GeometryOptions | None" = None):
+        self.walls = walls.copy()
+        self.alive = np.ones(len(walls), dtype=bool)
+        # Type name of every element, types do not change and added elements are appended
+        self.type_names = walls.type_names()
+        self.options = options or GeometryOptions()
+        self.next_room = max(rooms, default=0) + 1
+
+        # Node name -> quads and their winding, in the node order of `build_geometry`
+        self.meshes: "dict[str, tuple[np.ndarray, np.ndarray]]" = {}
+        self.rooms: "dict[int, list[tuple[float, float, float, float]]]" = {}
+        for room, rectangles in rooms.items():
+            self._set_room(room, rectangles)
+        # Rectangles of all rooms as [K, 4] rows and the room of every row
+        self.room_rectangles = np.array([rectangle for rectangles in rooms.values() for rectangle in rectangles], dtype=np.float64).reshape(-1, 4)
+        self.room_owners = np.repeat(np.array(list(rooms), dtype=np.int64), [len(rectangles) for rectangles in rooms.values()])
+        self._mesh_elements(np.arange(len(walls)))
+
+    @staticmethod
+    def from_detections(detections: Detections, options: "GeometryOptions | None" = None):
+        walls, rooms = analyze_plan(detections)
+        return GeometrySession(walls, rooms, options)
+
+    def _set_room(self, room: int, rectangles: "list[tuple[float, float, float, float]]"):
+        self.rooms[room] = rectangles
+        quads = floor_quads(rectangles)
+        self.meshes[f"Room_{room}"] = (quads, np.zeros(len(quads), dtype=bool))
+
+    def _touching(self, selection: np.ndarray, margin: float = 1e-4):
+        """
+        Alive elements touching any of the selected ones. Candidates share a
+        cell of the grid hash of `visible_faces` with a selected element.
+        """
+        walls = self.walls
+        touching = np.zeros(len(walls), dtype=bool)
+        alive = np.flatnonzero(self.alive)
+        if len(selection) == 0 or len(alive) == 0:
+            return touching
+
+        rectangles = np.stack((walls.x1, walls.y1, walls.x2, walls.y2), axis=1).astype(np.float64)
+        cell_size = grid_cell_size(rectangles[alive], margin)
+        owner, cell_x, cell_y = grid_cells(rectangles[alive], cell_size, margin)
+        owner = alive[owner]
+        selected, selected_x, selected_y = grid_cells(rectangles[selection], cell_size, margin)
+        selected = selection[selected]
+
+        # Cells as single keys, the selected ones are covered by the alive ones
+        low_x, low_y = cell_x.min(), cell_y.min()
+        rows = int(cell_y.max() - low_y) + 1
+        keys = (cell_x - low_x) * rows + (cell_y - low_y)
+        order = np.argsort(keys, kind="stable")
+        owner, keys = owner[order], keys[order]
+        selected_keys = (selected_x - low_x) * rows + (selected_y - low_y)
+        starts = np.searchsorted(keys, selected_keys, side="left")
+        ends = np.searchsorted(keys, selected_keys, side="right")
+
+        counts = ends - starts
+        index = np.repeat(selected, counts)
+        other = owner[np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        hit = (
+            (rectangles[other, 0] <= rectangles[index, 2] + margin) & (rectangles[other, 2] >= rectangles[index, 0] - margin)
+            & (rectangles[other, 1] <= rectangles[index, 3] + margin) & (rectangles[other, 3] >= rectangles[index, 1] - margin)
+        )
+        touching[other[hit]] = True
+        return touching
+
+    def _mesh_elements(self, selection: np.ndarray):
+        """
+        Meshes the selected alive elements, their hidden faces against every
+        element touching them. Returns the nodes of elements left without faces.
+        """
+        selection = selection[self.alive[selection]]
+        hidden: "list[str]" = []
+        if len(selection) == 0:
+            return hidden
+
+        occluders = np.flatnonzero(self._touching(selection) | np.isin(np.arange(len(self.walls)), selection))
+        table = self.walls.take(occluders)
+        boxes, element, _ = element_boxes(table)
+        faces = visible_faces(boxes) if self.options.hide_faces else None
+        quads, inverted, counts = cube_quads(boxes, faces)
+        ends = np.cumsum(counts)
+
+        selected = set(selection.tolist())
+        for local, index in enumerate(occluders.tolist()):
+            if index not in selected:
+                continue
+
+            if table.type[local] != WALL:
+                rectangle = [(table.x1[local], table.y1[local], table.x2[local], table.y2[local])]
+                self.meshes[f"Floor_{index}"] = (floor_quads(rectangle), np.zeros(1, dtype=bool))
+            boxes_of = np.flatnonzero(element == local)
+            start, end = ends[boxes_of[0]] - counts[boxes_of[0]], ends[boxes_of[-1]]
+            name = f"{self.type_names[index].capitalize()}_{index}"
+            # Elements hidden inside others have no faces left and no node, like in `build_geometry`
+            if start == end:
+                self.meshes.pop(name, None)
+                hidden.append(name)
+            else:
+                self.meshes[name] = (quads[start:end], inverted[start:end])
+        return hidden
+
+    def _remove_element(self, index: int):
+        name = f"{self.type_names[index].capitalize()}_{index}"
+        removed = [name for name in (f"Floor_{index}", name) if self.meshes.pop(name, None) is not None]
+        return removed
+
+    def _bounds(self, index: int):
+        walls = self.walls
+        return (float(walls.x1[index]), float(walls.y1[index]), float(walls.x2[index]), float(walls.y2[index]))
+
+    def _validate(self, edits: "list[dict]"):
+        """Raises ValueError for the first invalid edit, before any edit is applied"""
+        deleted = set()
+        for edit in edits:
+            operation = edit.get("op")
+            if operation not in EDIT_OPERATIONS:
+                raise ValueError(f"Unknown edit operation {operation!r}, expected one of {', '.join(EDIT_OPERATIONS)}")
+            if operation == "add" and (not isinstance(edit.get("type"), str) or edit["type"] not in TYPE_CODES):
+                raise ValueError(f"Unknown element type {edit.get('type')!r}")
+
+            keys = {"move": ("dx", "dy"), "delete": ()}.get(operation, ("x1", "y1", "x2", "y2"))
+            for key in keys:
+                if not _is_number(edit.get(key, 0 if operation == "move" else None)):
+                    raise ValueError(f"Edit {operation} expects a finite number for {key!r}")
+            if operation == "add":
+                continue
+
+            index = edit.get("id")
+            if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < len(self.walls) or not self.alive[index] or index in deleted:
+                raise ValueError(f"Unknown element id {index!r}")
+            if operation == "delete":
+                deleted.add(index)
+
+    def apply(self, edits: "list[dict]"):
+        """
+        Applies edits given as {"op": "move", "id", "dx", "dy"}, {"op": "resize",
+        "id", "x1", "y1", "x2", "y2"}, {"op": "add", "type", "x1", "y1", "x2",
+        "y2"} or {"op": "delete", "id"}. Returns the names of the changed or
+        added nodes and of the removed ones.
+        """
+
+        self._validate(edits)
+        walls = self.walls
+        # Plan boxes of the edited elements before and after the edits
+        touched: "list[tuple[float, float, float, float]]" = []
+        edited: "list[int]" = []
+        removed: "list[str]" = []
+        for edit in edits:
+            operation = edit["op"]
+            if operation == "add":
+                index = len(walls)
+                box = [float(edit[key]) for key in ("x1", "y1", "x2", "y2")]
+                x1, x2 = sorted(box[0::2])
+                y1, y2 = sorted(box[1::2])
+                # An added element joins the group of an element it touches
+                touching = np.flatnonzero(_overlapping(walls.x1, walls.y1, walls.x2, walls.y2, (x1, y1, x2, y2), 1e-4) & self.alive)
+                group = walls.group[touching[0]] if len(touching) else walls.group.max(initial=-1) + 1
+                self.walls = walls = WallTable(
+                    np.append(walls.x1, x1), np.append(walls.y1, y1), np.append(walls.x2, x2), np.append(walls.y2, y2),
+                    np.append(walls.type, TYPE_CODES[edit["type"]]), np.append(walls.group, group),
+                )
+                self.alive = np.append(self.alive, True)
+                self.type_names.append(edit["type"])
+                touched.append(self._bounds(index))
+                edited.append(index)
+                continue
+
+            index = edit["id"]
+            touched.append(self._bounds(index))
+            removed += self._remove_element(index)
+            if operation == "delete":
+                self.alive[index] = False
+                continue
+
+            if operation == "move":
+                walls.translate(index, float(edit.get("dx", 0)), float(edit.get("dy", 0)))
+            else:
+                box = [float(edit[key]) for key in ("x1", "y1", "x2", "y2")]
+                walls.x1[index], walls.x2[index] = sorted(box[0::2])
+                walls.y1[index], walls.y2[index] = sorted(box[1::2])
+            touched.append(self._bounds(index))
+            edited.append(index)
+
+        before = set(self.meshes)
+        changed = self._remesh_elements(touched, np.array(edited, dtype=np.int64), removed)
+        changed += self._find_rooms(touched, removed)
+
+        removed = [name for name in dict.fromkeys(removed) if name not in self.meshes]
+        changed = [name for name in dict.fromkeys(changed) if name in self.meshes]
+        changed += [name for name in self.meshes if name not in before and name not in changed]
+        return changed, removed
+
+    def _remesh_elements(self, touched: "list[tuple[float, float, float, float]]", edited: np.ndarray, removed: "list[str]"):
+        walls = self.walls
+        affected = np.zeros(len(walls), dtype=bool)
+        for box in touched:
+            affected |= _overlapping(walls.x1, walls.y1, walls.x2, walls.y2, box, 1e-4)
+        affected[edited] = True
+        selection = np.flatnonzero(affected & self.alive)
+        removed += self._mesh_elements(selection)
+
+        names = []
+        for index in selection.tolist():
+            names += [f"Floor_{index}", f"{self.type_names[index].capitalize()}_{index}"]
+        return names
+
+    def _find_rooms(self, touched: "list[tuple[float, float, float, float]]", removed: "list[str]"):
+        """Finds the rooms touching the edits again, on the walls around the rooms they touched before"""
+        if not touched:
+            return []
+
+        rectangles, owners = self.room_rectangles, self.room_owners
+        margin = 2 * ROOM_TOLERANCE
+        hit = np.zeros(len(rectangles), dtype=bool)
+        for box in touched:
+            hit |= _overlapping(*rectangles.T, box, margin)
+        affected = np.isin(owners, owners[hit])
+        corners = np.concatenate((np.array(touched), rectangles[affected]))
+        region = (corners[:, 0].min(), corners[:, 1].min(), corners[:, 2].max(), corners[:, 3].max())
+
+        walls = self.walls
+        nearby = np.flatnonzero(_overlapping(walls.x1, walls.y1, walls.x2, walls.y2, region, margin) & self.alive)
+        rooms = find_rooms(walls.take(nearby), ROOM_TOLERANCE)
+
+        for room in np.unique(owners[hit]).tolist():
+            del self.rooms[room]
+            del self.meshes[f"Room_{room}"]
+            removed.append(f"Room_{room}")
+
+        # Rooms not touching an edit are the same as before, or left the region and are incomplete
+        added = []
+        kept_rectangles = [rectangles[~affected]]
+        kept_owners = [owners[~affected]]
+        for room_rectangles in rooms.values():
+            room_rectangles = np.array(room_rectangles, dtype=np.float64)
+            if any(_overlapping(*room_rectangles.T, box, margin).any() for box in touched):
+                room = self.next_room
+                self.next_room += 1
+                self._set_room(room, [tuple(rectangle) for rectangle in room_rectangles.tolist()])
+                kept_rectangles.append(room_rectangles)
+                kept_owners.append(np.full(len(room_rectangles), room))
+                added.append(f"Room_{room}")
+
+        self.room_rectangles = np.concatenate(kept_rectangles)
+        self.room_owners = np.concatenate(kept_owners)
+        return added
+
+    def build(self, names: "list[str] | None" = None):
+        """glTF of all nodes, or only of the given ones"""
+        names = list(self.meshes) if names is None else names
+        builder = MeshBuilder(packed=self.options.packed, quantize=self.options.quantize, compress=self.options.compress, hierarchy=self.options.hierarchy)
+        if names:
+            builder.add_quads(np.concatenate([self.meshes[name][0] for name in names]), np.concatenate([self.meshes[name][1] for name in names]))
+            builder.create_meshes(names, [len(self.meshes[name][0]) for name in names])
+        return builder.build()
+
+class SessionStore:
+    """Sessions by id, the least recently used ones are dropped beyond `capacity`"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, tuple[threading.Lock, GeometrySession]]" = OrderedDict()
+
+    def add(self, session: GeometrySession):
+        id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[id] = (threading.Lock(), session)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+        return id
+
+    def get(self, id: str):
+        """The lock and session of `id`, edits of one session run one at a time"""
+        with self._lock:
+            entry = self._sessions.get(id)
+            if entry is not None:
+                self._sessions.move_to_end(id)
+            return entry
+
+    def remove(self, id: str):
+        with self._lock:
+            return self._sessions.pop(id, None) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)